@@ -0,0 +1,242 @@
+"""Class-wide grade analytics for a teacher, computed over column arrays.
+
+ClassColumns loads a teacher's grades and latest targets into flat arrays of
+codes and scores. class_report() turns them into per-subject statistics
+(mean, percentiles, student_grading bands, target attainment, term-over-term
+change) with whole-column passes: NumPy when it is installed, plain loops
+over the same arrays otherwise. Both give the same numbers.
+"""
+import os
+from array import array
+from bisect import bisect_right
+from model import stream_query
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Lowest score of the D, C, B and A bands of model.student_grading; below 40 is E.
+BAND_EDGES = (40, 49, 60, 80)
+BANDS = ('E', 'D', 'C', 'B', 'A')
+PERCENTILES = (10, 25, 50, 75, 90)
+# Terms split the calendar year evenly: with 3, T1 is January-April.
+TERMS_PER_YEAR = int(os.environ.get('TERMS_PER_YEAR', 3))
+
+# Term number (year * TERMS_PER_YEAR + term index) of created_at, or -1 if it isn't a date.
+TERM_SQL = f'''CASE WHEN g.created_at GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'
+    THEN CAST(substr(g.created_at, 1, 4) AS INTEGER) * {TERMS_PER_YEAR}
+         + (CAST(substr(g.created_at, 6, 2) AS INTEGER) - 1) * {TERMS_PER_YEAR} / 12
+    ELSE -1 END'''
+
+def term_label(key):
+    return f'{key // TERMS_PER_YEAR}-T{key % TERMS_PER_YEAR + 1}'
+
+def _columns(sql, params, width):
+    """Run a query and return its result as `width` column lists."""
+    columns = [[] for _ in range(width)]
+    for rows in stream_query(sql, params):
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return columns
+
+def _encode(values, known):
+    """Return values as an array of codes into `known`, appending unseen values to it."""
+    codes = {v: i for i, v in enumerate(known)}
+    for v in dict.fromkeys(values):
+        if v not in codes:
+            codes[v] = len(known)
+            known.append(v)
+    return array('q', map(codes.__getitem__, values))
+
+class ClassColumns:
+    """A teacher's grades as parallel arrays, plus each student's latest target per subject.
+
+    students/subjects map codes back to ids and names. Grade columns:
+    student, subject, score, term; target columns: target_student,
+    target_subject, target.
+    """
+    def __init__(self, teacher_id):
+        self.students, self.subjects = [], []
+        student_ids, subjects, scores, terms = _columns(f'''SELECT g.student_id, g.subject, g.score, {TERM_SQL}
+                                                          FROM students s JOIN grades g ON g.student_id = s.id
+                                                          WHERE s.teacher_id = ? AND g.score IS NOT NULL''', (teacher_id,), 4)
+        self.student = _encode(student_ids, self.students)
+        self.subject = _encode(subjects, self.subjects)
+        self.score = array('d', scores)
+        self.term = array('q', terms)
+        self.graded_students = len(self.students)
+        # Later rows win, leaving each student's latest target per subject.
+        student_ids, subjects, targets = _columns('''SELECT t.student_id, t.subject, t.target FROM students s
+                                                    JOIN targets t ON t.student_id = s.id
+                                                    WHERE s.teacher_id = ? AND t.target IS NOT NULL
+                                                    ORDER BY t.created_at, t.rowid''', (teacher_id,), 3)
+        latest = dict(zip(zip(_encode(student_ids, self.students), _encode(subjects, self.subjects)), targets))
+        self.target_student = array('q', (k[0] for k in latest))
+        self.target_subject = array('q', (k[1] for k in latest))
+        self.target = array('d', latest.values())
+
+    def __len__(self):
+        return len(self.score)
+
+def _percentile(sorted_scores, start, count, p):
+    """Linearly interpolated percentile of sorted_scores[start:start + count] (NumPy's default method)."""
+    position = (count - 1) * p / 100
+    lo = int(position)
+    hi = min(lo + 1, count - 1)
+    low = sorted_scores[start + lo]
+    return low + (sorted_scores[start + hi] - low) * (position - lo)
+
+def _group_stats_numpy(cols, group, groups):
+    """Per-group count, sum, min, max, percentiles and band counts, in vectorized passes."""
+    score = np.frombuffer(cols.score, dtype=np.float64)
+    counts = np.bincount(group, minlength=groups)
+    sums = np.bincount(group, weights=score, minlength=groups)
+    # Sorted by group, then score; the trailing 0 is what empty groups (zeroed below) point at.
+    sorted_scores = np.append(score[np.lexsort((score, group))], 0.0)
+    starts = np.cumsum(counts) - counts
+    last = np.maximum(counts - 1, 0)
+    graded = counts > 0
+    stats = {'count': counts, 'sum': sums,
+             'min': np.where(graded, sorted_scores[starts], 0.0), 'max': np.where(graded, sorted_scores[starts + last], 0.0)}
+    for p in PERCENTILES:
+        position = last * p / 100
+        lo = position.astype(np.int64)
+        low = sorted_scores[starts + lo]
+        value = low + (sorted_scores[starts + np.minimum(lo + 1, last)] - low) * (position - lo)
+        stats[p] = np.where(graded, value, 0.0)
+    band = np.searchsorted(BAND_EDGES, np.trunc(score), side='right')
+    stats['bands'] = np.bincount(group * len(BANDS) + band, minlength=groups * len(BANDS)).reshape(groups, len(BANDS))
+    return {k: v.tolist() for k, v in stats.items()}
+
+def _group_stats_python(cols, group, groups):
+    """Same as _group_stats_numpy, one loop at a time."""
+    counts = [0] * groups
+    sums = [0.0] * groups
+    members = [[] for _ in range(groups)]
+    bands = [[0] * len(BANDS) for _ in range(groups)]
+    for g, score in zip(group, cols.score):
+        counts[g] += 1
+        sums[g] += score
+        members[g].append(score)
+        bands[g][bisect_right(BAND_EDGES, int(score))] += 1
+    stats = {'count': counts, 'sum': sums, 'min': [0.0] * groups, 'max': [0.0] * groups, 'bands': bands}
+    for p in PERCENTILES:
+        stats[p] = [0.0] * groups
+    for g, scores in enumerate(members):
+        if not scores:
+            continue
+        scores.sort()
+        stats['min'][g], stats['max'][g] = scores[0], scores[-1]
+        for p in PERCENTILES:
+            stats[p][g] = _percentile(scores, 0, len(scores), p)
+    return stats
+
+def _subject_extras_numpy(cols, terms):
+    """Target attainment and per-term sums for each subject, in vectorized passes."""
+    subjects = len(cols.subjects)
+    subject = np.frombuffer(cols.subject, dtype=np.int64)
+    score = np.frombuffer(cols.score, dtype=np.float64)
+    pair = np.frombuffer(cols.student, dtype=np.int64) * subjects + subject
+    pair_counts = np.bincount(pair, minlength=len(cols.students) * subjects)
+    pair_sums = np.bincount(pair, weights=score, minlength=len(cols.students) * subjects)
+    target_subject = np.frombuffer(cols.target_subject, dtype=np.int64)
+    target = np.frombuffer(cols.target, dtype=np.float64)
+    target_pair = np.frombuffer(cols.target_student, dtype=np.int64) * subjects + target_subject
+    graded = pair_counts[target_pair] > 0
+    averages = pair_sums[target_pair] / np.maximum(pair_counts[target_pair], 1)
+    extras = {
+        'targets_set': np.bincount(target_subject, minlength=subjects),
+        'targets_graded': np.bincount(target_subject[graded], minlength=subjects),
+        'targets_met': np.bincount(target_subject[graded & (averages >= target)], minlength=subjects),
+        'target_gap_sum': np.bincount(target_subject[graded], weights=(averages - target)[graded], minlength=subjects),
+    }
+    term = np.frombuffer(cols.term, dtype=np.int64)
+    dated = term >= 0
+    cell = subject[dated] * len(terms) + np.searchsorted(terms, term[dated])
+    extras['term_counts'] = np.bincount(cell, minlength=subjects * len(terms)).reshape(subjects, len(terms))
+    extras['term_sums'] = np.bincount(cell, weights=score[dated], minlength=subjects * len(terms)).reshape(subjects, len(terms))
+    return {k: v.tolist() for k, v in extras.items()}
+
+def _subject_extras_python(cols, terms):
+    """Same as _subject_extras_numpy, one loop at a time."""
+    subjects = len(cols.subjects)
+    pair_counts, pair_sums = {}, {}
+    for pair in zip(cols.student, cols.subject, cols.score):
+        key = pair[:2]
+        pair_counts[key] = pair_counts.get(key, 0) + 1
+        pair_sums[key] = pair_sums.get(key, 0.0) + pair[2]
+    extras = {name: [0] * subjects for name in ('targets_set', 'targets_graded', 'targets_met')}
+    extras['target_gap_sum'] = [0.0] * subjects
+    for student, subject, target in zip(cols.target_student, cols.target_subject, cols.target):
+        extras['targets_set'][subject] += 1
+        count = pair_counts.get((student, subject))
+        if not count:
+            continue
+        average = pair_sums[student, subject] / count
+        extras['targets_graded'][subject] += 1
+        extras['targets_met'][subject] += average >= target
+        extras['target_gap_sum'][subject] += average - target
+    index = {term: i for i, term in enumerate(terms)}
+    extras['term_counts'] = [[0] * len(terms) for _ in range(subjects)]
+    extras['term_sums'] = [[0.0] * len(terms) for _ in range(subjects)]
+    for subject, score, term in zip(cols.subject, cols.score, cols.term):
+        if term >= 0:
+            extras['term_counts'][subject][index[term]] += 1
+            extras['term_sums'][subject][index[term]] += score
+    return extras
+
+def _summary(stats, g):
+    count = stats['count'][g]
+    if not count:
+        return {'count': 0, 'mean': None, 'min': None, 'max': None, 'median': None,
+                **{f'p{p}': None for p in PERCENTILES if p != 50}, 'bands': dict.fromkeys(BANDS, 0)}
+    summary = {'count': count, 'mean': round(stats['sum'][g] / count, 2),
+               'min': stats['min'][g], 'max': stats['max'][g], 'median': round(stats[50][g], 2)}
+    summary.update((f'p{p}', round(stats[p][g], 2)) for p in PERCENTILES if p != 50)
+    summary['bands'] = dict(zip(BANDS, stats['bands'][g]))
+    return summary
+
+def class_report(teacher_id, use_numpy=None):
+    """Return a teacher's class analytics as a JSON-ready dict.
+
+    `use_numpy` forces one code path; by default NumPy is used when installed.
+    """
+    use_numpy = np is not None if use_numpy is None else use_numpy
+    cols = ClassColumns(teacher_id)
+    subjects = len(cols.subjects)
+    terms = sorted({t for t in cols.term if t >= 0})
+    if use_numpy:
+        stats = _group_stats_numpy(cols, np.frombuffer(cols.subject, dtype=np.int64), subjects)
+        overall = _group_stats_numpy(cols, np.zeros(len(cols), dtype=np.int64), 1)
+        extras = _subject_extras_numpy(cols, np.array(terms, dtype=np.int64))
+    else:
+        stats = _group_stats_python(cols, cols.subject, subjects)
+        overall = _group_stats_python(cols, [0] * len(cols), 1)
+        extras = _subject_extras_python(cols, terms)
+
+    report = []
+    for s, name in enumerate(cols.subjects):
+        entry = {'subject': name, **_summary(stats, s)}
+        graded = extras['targets_graded'][s]
+        entry['targets'] = {'set': extras['targets_set'][s], 'graded': graded, 'met': extras['targets_met'][s],
+                            'mean_gap': round(extras['target_gap_sum'][s] / graded, 2) if graded else None}
+        entry['terms'] = []
+        previous = None
+        for t, term in enumerate(terms):
+            count = extras['term_counts'][s][t]
+            if not count:
+                continue
+            mean = extras['term_sums'][s][t] / count
+            entry['terms'].append({'term': term_label(term), 'count': count, 'mean': round(mean, 2),
+                                   'delta': round(mean - previous, 2) if previous is not None else None})
+            previous = mean
+        report.append(entry)
+    report.sort(key=lambda e: (e['subject'] is None, str(e['subject'])))
+    return {
+        'teacher_id': teacher_id,
+        'students': cols.graded_students,
+        'overall': _summary(overall, 0),
+        'subjects': report,
+        'engine': 'numpy' if use_numpy else 'python',
+    }
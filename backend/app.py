@@ -1,126 +1,290 @@
-from flask import Flask, request, jsonify, send_from_directory
+import os
+
+# gevent (the production runtime, see gunicorn.conf.py) needs the stdlib patched
+# before anything else imports it; ASYNC_MODE=threading opts out.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'gevent')
+if ASYNC_MODE == 'gevent':
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        ASYNC_MODE = 'threading'
+
+from flask import Flask, request, jsonify, send_file, session, Response
 from flask_cors import CORS
-from flask_socketio import SocketIO
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_socketio import SocketIO, join_room, leave_room, rooms
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import sqlite3
-import os
-from datetime import datetime
+import uuid
+import mimetypes
+import io
+import csv
+import atexit
+import click
+from datetime import datetime, timedelta
 from model import (
     Users, Students, Grades, Chatrooms, ChatroomMembers, Messages,
     Groups, GroupMembers, Targets, Remarks, Notifications,
-    PrivateMessages, Assignments, student_grading
+    PrivateMessages, Assignments, GradeStats, ResourceVersions, student_grading, decode_cursor, next_cursor, db_cursor,
+    LRUCache, LocalRedis, cache, chat_cache
 )
+import analytics
+import migrations
+import model
+import metrics
+import pubsub
+import search
+import seed
+from notifier import NotificationWriter, MessageWriter, NotStored
+import storage
+import thumbnails
+from passwords import hasher, HashingBusy
+
+try:
+    import orjson
+    encode_json = orjson.dumps
+except ImportError:
+    import json
+    encode_json = lambda value: json.dumps(value, separators=(',', ':')).encode()
 
 app = Flask(__name__)
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    # Fine for a development server; gunicorn.conf.py refuses to start without a key.
+    print('WARNING: SECRET_KEY is not set. Using a random key, so socket and search tokens stop working on restart.')
+    app.config['SECRET_KEY'] = os.urandom(24).hex()
+# Werkzeug rejects larger bodies from Content-Length before reading them.
+app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
+# Let a fronting Apache/lighttpd send upload bodies; under gunicorn send_file
+# already goes through wsgi.file_wrapper, which uses sendfile().
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-   # Define absolute path for SQLite database
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, 'grade_manager.db')
+# Set with more than one worker process, e.g. redis://localhost:6379/0 or
+# local:///tmp/socketio.sock (see pubsub.py).
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+socket_manager = pubsub.make_manager(SOCKETIO_MESSAGE_QUEUE)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, client_manager=socket_manager)
+socket_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='socket-auth')
+# Seconds a socket_token (also the search bearer token) is accepted after login.
+SOCKET_TOKEN_MAX_AGE = int(os.environ.get('SOCKET_TOKEN_MAX_AGE', 7 * 24 * 3600))
 
 def init_db():
-    """Initialize database tables."""
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            email TEXT UNIQUE,
-            password TEXT,
-            role TEXT,
-            bio TEXT,
-            profile_photo TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS students (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            email TEXT,
-            teacher_id TEXT,
-            profile_photo TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS grades (
-            id TEXT PRIMARY KEY,
-            student_id TEXT,
-            subject TEXT,
-            score INTEGER,
-            grade TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS chatrooms (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            teacher_id TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS chatroom_members (
-            chatroom_id TEXT,
-            user_id TEXT,
-            PRIMARY KEY (chatroom_id, user_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (
-            id TEXT PRIMARY KEY,
-            chatroom_id TEXT,
-            user_id TEXT,
-            content TEXT,
-            type TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS groups (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            teacher_id TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS group_members (
-            group_id TEXT,
-            user_id TEXT,
-            PRIMARY KEY (group_id, user_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS targets (
-            id TEXT PRIMARY KEY,
-            student_id TEXT,
-            subject TEXT,
-            target INTEGER,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS remarks (
-            id TEXT PRIMARY KEY,
-            student_id TEXT,
-            teacher_id TEXT,
-            content TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS notifications (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            content TEXT,
-            created_at TIMESTAMP,
-            is_read INTEGER DEFAULT 0
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS private_messages (
-            id TEXT PRIMARY KEY,
-            sender_id TEXT,
-            receiver_id TEXT,
-            content TEXT,
-            type TEXT,
-            created_at TIMESTAMP
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS assignments (
-            id TEXT PRIMARY KEY,
-            student_id TEXT,
-            teacher_id TEXT,
-            title TEXT,
-            file_path TEXT,
-            status TEXT,
-            created_at TIMESTAMP
-        )''')
-        conn.commit()
+    """Bring the database schema up to date and warn about lookups that lost their index."""
+    migrations.upgrade()
+    for sql, plan in migrations.check_query_plans():
+        print(f'Lookup does not use its index: {sql} ({"; ".join(plan)})')
+
+def user_room(user_id):
+    return f'user:{user_id}'
+
+def chatroom_room(chatroom_id):
+    return f'chatroom:{chatroom_id}'
+
+def emit_notification(record):
+    notification_id, user_id, content, created_at = record
+    socketio.emit('notification', {'id': notification_id, 'user_id': user_id, 'content': content, 'created_at': str(created_at)},
+                  to=user_room(user_id), namespace='/')
+
+def emit_chat_message(record):
+    socketio.emit('chat_message', chat_message_json(record), to=chatroom_room(record[1]), namespace='/')
+
+# SYNC_WRITES=1 makes both writers store records inline (tests).
+SYNC_WRITES = os.environ.get('SYNC_WRITES') == '1'
+# Seconds a chat message sender waits for the message to be stored before getting a "queued" reply.
+MESSAGE_WRITE_TIMEOUT = float(os.environ.get('MESSAGE_WRITE_TIMEOUT', 5))
+notifier = NotificationWriter(emit_notification, synchronous=SYNC_WRITES)
+atexit.register(notifier.stop)
+message_writer = MessageWriter(emit_chat_message, flush_interval=0, synchronous=SYNC_WRITES)
+atexit.register(message_writer.stop)
+
+# Messages handed to a socket when it joins a chatroom.
+CHAT_HISTORY_ON_JOIN = 50
+atexit.register(thumbnails.shutdown)
+atexit.register(hasher.shutdown)
 
 def notify_user(user_id, content):
-    """Send a notification to a user via SocketIO and store it."""
-    Notifications.create(user_id, content)
-    socketio.emit('notification', {'user_id': user_id, 'content': content, 'created_at': str(datetime.now())}, namespace='/')
+    """Queue a notification for a user; it is stored and pushed via SocketIO in the background."""
+    notifier.submit(user_id, content)
+
+def message_json(m):
+    return {'id': m['id'], 'user_id': m['user_id'], 'content': m['content'], 'type': m['type'], 'created_at': m['created_at']}
+
+def chat_message_json(record):
+    message_id, chatroom_id, user_id, content, msg_type, created_at = record
+    return {'id': message_id, 'chatroom_id': chatroom_id, 'user_id': user_id, 'content': content,
+            'type': msg_type, 'created_at': str(created_at)}
+
+def post_chat_message(chatroom_id, user_id, content, msg_type):
+    """Store a chat message through the group-committing writer, which then fans it out to its room.
+
+    Raises NotStored if the message is still queued after MESSAGE_WRITE_TIMEOUT.
+    """
+    record = message_writer.submit(chatroom_id, user_id, content, msg_type, wait=MESSAGE_WRITE_TIMEOUT)
+    return chat_message_json(record)
+
+def evict_local(user_id, room):
+    """Remove user_id's sockets connected to this worker from room."""
+    sids = [sid for sid, _ in socketio.server.manager.get_participants('/', user_room(user_id))]
+    for sid in sids:
+        socketio.server.leave_room(sid, room, namespace='/')
+
+def evict_from_room(user_id, room):
+    """Remove every socket belonging to user_id from room, on every worker."""
+    evict_local(user_id, room)
+    if socket_manager is not None:
+        socket_manager.broadcast('evict', user_id, room)
+
+def start_message_queue():
+    """Keep this worker's caches and rooms in step with the other workers.
+
+    The listener starts now instead of on the first socket connection, so a
+    worker that only serves HTTP still sees the other workers' cache updates.
+    """
+    pubsub.sync_cache(socket_manager, 'chat_cache', chat_cache)
+    if isinstance(cache, LRUCache) or isinstance(getattr(cache, 'client', None), LocalRedis):
+        pubsub.sync_cache(socket_manager, 'row_cache', cache)
+    socket_manager.on('evict', evict_local)
+    socketio.server.manager_initialized = True
+    socket_manager.initialize()
+
+if socket_manager is not None:
+    start_message_queue()
+
+if metrics.METRICS_ENABLED:
+    model.query_observer = metrics.observe_query
+
+@app.before_request
+def start_request_metrics():
+    if metrics.METRICS_ENABLED:
+        metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def finish_request_metrics(response):
+    """Record the request and report its SQL cost in a Server-Timing header."""
+    if metrics.METRICS_ENABLED and response.is_streamed:
+        # The body (and its queries) comes later; record the request once it has been sent.
+        method, status = request.method, response.status_code
+        response.call_on_close(lambda: metrics.finish_request(method, status))
+        return response
+    state = metrics.finish_request(request.method, response.status_code) if metrics.METRICS_ENABLED else None
+    if state is not None:
+        response.headers['Server-Timing'] = (f'db;dur={state["db_seconds"] * 1000:.2f};desc="{state["queries"]} statements", '
+                                             f'app;dur={state["seconds"] * 1000:.2f}')
+    return response
+
+@app.errorhandler(model.PoolExhausted)
+def database_busy(e):
+    return jsonify({'message': 'Server busy, try again'}), 503
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if metrics.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {metrics.METRICS_TOKEN}':
+        return jsonify({'message': 'Unauthorized'}), 401
+    extra = [
+        ('db_pool', model.pool.stats(), 'SQLite connection pool.'),
+        ('row_cache', cache.stats(), 'User/student row cache.'),
+        ('chat_cache', chat_cache.stats(), 'Chatroom history and member cache.'),
+        ('response_cache', response_cache.stats(), 'Rendered bodies of versioned list endpoints.'),
+        ('notification_writer', notifier.stats(), 'Background notification writer.'),
+        ('message_writer', message_writer.stats(), 'Background chat message writer.'),
+        ('password_hasher', hasher.stats(), 'Password hashing pool.'),
+    ]
+    if socket_manager is not None:
+        extra.append(('socketio_queue', socket_manager.stats(), 'Cross-worker Socket.IO message queue.'))
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_GRADES_PER_STUDENT = 8
+MAX_BULK_ROWS = 5000
+MAX_PHOTO_BYTES = 5 * 1024 * 1024
+MAX_ASSIGNMENT_BYTES = 20 * 1024 * 1024
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+# Latest rendered body of each versioned list endpoint (see versioned_response); larger ones aren't kept.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 64))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+response_cache = LRUCache(maxsize=RESPONSE_CACHE_SIZE, ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 600)))
+
+def page_args():
+    """Read limit/before/after from the query string; raise ValueError if malformed.
+
+    Returns (None, None, None) when the client did not ask for a page, so list
+    endpoints keep returning everything to callers that predate pagination.
+    """
+    before = request.args.get('before')
+    after = request.args.get('after')
+    limit = request.args.get('limit')
+    if limit is None and not before and not after:
+        return None, None, None
+    limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    for cursor in (before, after):
+        if cursor:
+            decode_cursor(cursor)
+    return min(limit, MAX_PAGE_SIZE), before, after
+
+def page_response(items, rows, limit, after, descending=False):
+    """Wrap a page as {'items', 'next_cursor'}, or a bare list when not paginated."""
+    if not limit:
+        return jsonify(items)
+    return jsonify({'items': items, 'next_cursor': next_cursor(rows, limit, after, descending)})
+
+def stream_response(batches, fields):
+    """Return a JSON array of `fields` from each row of `batches` (see model.stream_keyset), streamed.
+
+    Rows are encoded one batch at a time, so memory use and time to first
+    byte stay the same however many rows match. The first batch is fetched
+    here, so a failing query is still an ordinary 500 before any of the body
+    is sent.
+    """
+    first = next(batches, None)
+
+    def generate():
+        batch, separator = first, b'['
+        while batch:
+            yield separator + encode_json([{f: row[f] for f in fields} for row in batch])[1:-1]
+            batch, separator = next(batches, None), b','
+        yield b']' if separator == b',' else b'[]'
+
+    response = Response(generate(), mimetype='application/json')
+    response.call_on_close(batches.close)
+    return response
+
+def versioned_response(resources, render):
+    """Answer a GET whose body only depends on the tables in `resources`.
+
+    The ETag is built from their versions (see migrations.RESOURCE_VERSIONS).
+    A matching If-None-Match gets a 304 without touching the data; otherwise
+    the body comes from response_cache, keyed by path and query string, or
+    from render() and is cached (see cache_body). Versions are read before
+    rendering, so a body is never older than its ETag claims.
+    """
+    versions = ResourceVersions.get(*resources)
+    etag = '-'.join(f'{r}.{v}' for r, v in zip(resources, versions))
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        found, cached = response_cache.get(request.full_path)
+        if found and cached[0] == versions:
+            response = Response(cached[1], mimetype='application/json')
+        else:
+            response = cache_body(request.full_path, versions, render())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def cache_body(key, versions, response):
+    """Store a successful response's body for `versions` in response_cache.
+
+    Streamed bodies are sent as they are read and never buffered here, so
+    they keep their flat memory use; their ETag still answers with 304s.
+    """
+    if response.status_code == 200 and not response.is_streamed:
+        body = response.get_data()
+        if len(body) <= RESPONSE_CACHE_MAX_BYTES:
+            response_cache.set(key, (versions, body))
+    return response
 
 @app.route('/api/signup', methods=['POST'])
 def signup():
@@ -134,7 +298,10 @@ def signup():
     if not all([name, email, password, role]):
         return jsonify({'message': 'Missing required fields'}), 400
 
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = hasher.hash(password)
+    except HashingBusy:
+        return jsonify({'message': 'Server busy, try again'}), 503
     try:
         user_id = Users.create(name, email, hashed_password, role, bio='', profile_photo=None)
         if role == 'student':
@@ -148,7 +315,8 @@ def signup():
                 'role': role,
                 'teacher_id': teacher_id,
                 'bio': '',
-                'profile_photo': None
+                'profile_photo': None,
+                'socket_token': socket_tokens.dumps(user_id)
             }
         }), 201
     except sqlite3.IntegrityError:
@@ -162,14 +330,25 @@ def login():
     role = data.get('role')
 
     user = Users.get_by_email(email)
-    if user and check_password_hash(user['password'], password) and user['role'] == role:
+    try:
+        valid = user is not None and hasher.verify(user['password'], password)
+    except HashingBusy:
+        return jsonify({'message': 'Server busy, try again'}), 503
+    if valid and user['role'] == role:
+        if hasher.needs_rehash(user['password']):
+            try:
+                Users.update(user['id'], password=hasher.hash(password))
+                hasher.note_rehash()
+            except HashingBusy:
+                pass
         user_data = {
             'id': user['id'],
             'name': user['name'],
             'email': user['email'],
             'role': user['role'],
             'bio': user['bio'],
-            'profile_photo': user['profile_photo']
+            'profile_photo': user['profile_photo'],
+            'socket_token': socket_tokens.dumps(user['id'])
         }
         if role == 'student':
             student = Students.get_by_id(user['id'])
@@ -208,7 +387,7 @@ def manage_profile(id):
 
         try:
             if password:
-                hashed_password = generate_password_hash(password)
+                hashed_password = hasher.hash(password)
                 Users.update(id, name=name, email=email, password=hashed_password, bio=bio)
             else:
                 Users.update(id, name=name, email=email, bio=bio)
@@ -216,6 +395,8 @@ def manage_profile(id):
                 Students.update(id, name=name, email=email)
             notify_user(id, "Your profile was updated")
             return jsonify({'message': 'Profile updated'})
+        except HashingBusy:
+            return jsonify({'message': 'Server busy, try again'}), 503
         except sqlite3.IntegrityError:
             return jsonify({'message': 'Email already exists'}), 400
 
@@ -229,41 +410,79 @@ def upload_profile_photo(id):
         if '.' not in photo.filename or photo.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
             return jsonify({'message': 'Invalid file type'}), 400
         filename = f"{id}_{uuid.uuid4().hex[:8]}.{photo.filename.rsplit('.', 1)[1].lower()}"
-        upload_path = os.path.join('uploads', filename)
+        if not Users.get_by_id(id):
+            return jsonify({'message': 'User not found'}), 404
         try:
-            photo.save(upload_path)
-            Users.update(id, profile_photo=filename)
-            if Students.get_by_id(id):
-                Students.update(id, profile_photo=filename)
+            sha256 = storage.save_stream(photo.stream, filename, MAX_PHOTO_BYTES, original_name=photo.filename)
+            thumbnails.schedule(storage.blob_path(sha256), sha256)
+            try:
+                # Swap the reference and release the old file in one transaction, under its write lock.
+                with db_cursor():
+                    previous = Users.set_profile_photo(id, filename)
+                    if previous:
+                        storage.release(previous)
+            except Exception:
+                storage.release(filename)
+                raise
             notify_user(id, "Profile photo updated")
             return jsonify({'message': 'Photo uploaded', 'photo': filename})
+        except storage.UploadTooLarge as e:
+            return jsonify({'message': str(e)}), 413
         except Exception as e:
             return jsonify({'message': f'Upload failed: {str(e)}'}), 500
     return jsonify({'message': 'Invalid photo'}), 400
 
 @app.route('/uploads/<filename>', methods=['GET'])
 def serve_uploaded_file(filename):
-    return send_from_directory('uploads', filename)
+    """Serve an upload with a content-hash ETag, Range support and year-long caching.
+
+    Upload names are never reused (each carries a fresh uuid suffix), so the
+    response can be marked immutable. Images accept ?size=48|128|256 (and an
+    optional ?format=webp|jpeg) to get a square avatar variant instead.
+    """
+    path, sha256 = storage.path_for(filename)
+    if not path:
+        return jsonify({'message': 'File not found'}), 404
+    size = request.args.get('size', type=int)
+    if size is not None:
+        if size not in thumbnails.AVATAR_SIZES:
+            return jsonify({'message': f'size must be one of {thumbnails.AVATAR_SIZES}'}), 400
+        accepts_webp = any(mimetype == 'image/webp' for mimetype, _ in request.accept_mimetypes)
+        fmt = request.args.get('format') or ('webp' if accepts_webp else 'jpeg')
+        if fmt not in thumbnails.VARIANT_FORMATS:
+            return jsonify({'message': 'format must be webp or jpeg'}), 400
+        variant = thumbnails.lookup(sha256, size, fmt) if sha256 else None
+        if variant:
+            response = send_file(variant, mimetype=f'image/{fmt}', etag=f'{sha256}-{size}.{fmt}', max_age=UPLOAD_MAX_AGE)
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            response.vary.add('Accept')
+            return response
+        if sha256 and (mimetypes.guess_type(filename)[0] or '').startswith('image/'):
+            thumbnails.schedule(path, sha256)
+        # Not rendered yet: send the original, but don't let caches pin it to this URL.
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], download_name=filename, etag=sha256 or True)
+        response.cache_control.no_cache = True
+        return response
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], download_name=filename,
+                         etag=sha256 or True, max_age=UPLOAD_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.accept_ranges = 'bytes'
+    return response
 
 @app.route('/api/students', methods=['GET', 'POST'])
 def manage_students():
     if request.method == 'GET':
-        students = Students.get_all()
-        result = []
-        for student in students:
-            grades = Grades.get_by_student(student['id'])
-            total_score = sum(grade['score'] for grade in grades[:7])
-            general_grade = student_grading(total_score / min(len(grades), 7)) if grades else 'E'
-            result.append({
-                'id': student['id'],
-                'name': student['name'],
-                'email': student['email'],
-                'profile_photo': student['profile_photo'],
-                'teacher_id': student['teacher_id'],
-                'general_grade': general_grade
-            })
-        result.sort(key=lambda x: {'A': 5, 'B': 4, 'C': 3, 'D': 2, 'E': 1}.get(x['general_grade'], 1), reverse=True)
-        return jsonify(result)
+        # The general grade (and the order) come from grades.
+        return versioned_response(('students', 'grades'), lambda: jsonify([{
+            'id': s['id'],
+            'name': s['name'],
+            'email': s['email'],
+            'profile_photo': s['profile_photo'],
+            'teacher_id': s['teacher_id'],
+            'general_grade': s['general_grade']
+        } for s in Students.get_all_with_general_grade()]))
 
     if request.method == 'POST':
         data = request.get_json()
@@ -273,11 +492,13 @@ def manage_students():
         if not name or not email or not teacher_id:
             return jsonify({'message': 'Name, email, and teacher ID cannot be empty'}), 400
         try:
-            student_id = Users.create(name, email, generate_password_hash('default123'), 'student')
+            student_id = Users.create(name, email, hasher.hash('default123'), 'student')
             Students.create(student_id, name, email, teacher_id)
             notify_user(teacher_id, f"Added student {name}")
             notify_user(student_id, f"You were added to {name}'s class")
             return jsonify({'message': 'Student added'}), 201
+        except HashingBusy:
+            return jsonify({'message': 'Server busy, try again'}), 503
         except sqlite3.IntegrityError:
             return jsonify({'message': 'Email already exists'}), 400
 
@@ -317,34 +538,38 @@ def update_delete_student(id):
         student = Students.get_by_id(id)
         if not student:
             return jsonify({'message': 'Student not found'}), 404
-        Students.delete(id)
-        Users.delete(id)
+        with db_cursor():
+            files = Assignments.delete_by_student(id) + [Students.delete(id), Users.delete(id)]
+            # Released with the rows that named them, so no file outlives its last reference.
+            for filename in set(filter(None, files)):
+                storage.release(filename)
         notify_user(student['teacher_id'], f"Student {id} was removed")
         return jsonify({'message': 'Student deleted'})
 
 @app.route('/api/students/<id>/trends', methods=['GET'])
 def get_student_trends(id):
     grades = Grades.get_by_student(id)
-    avg_score = sum(g['score'] for g in grades) / len(grades) if grades else 0
-    subject_avgs = {}
-    for g in grades:
-        subject = g['subject']
-        if subject not in subject_avgs:
-            subject_avgs[subject] = {'total': 0, 'count': 0}
-        subject_avgs[subject]['total'] += g['score']
-        subject_avgs[subject]['count'] += 1
-    subject_averages = [{'subject': k, 'avg_score': v['total'] / v['count']} for k, v in subject_avgs.items()]
+    stats = GradeStats.for_student(id)
+    avg_score = stats['score_sum'] / stats['grade_count'] if stats else 0
+    subject_averages = [{'subject': s['subject'], 'avg_score': s['score_sum'] / s['grade_count']}
+                        for s in GradeStats.for_student_subjects(id)]
     return jsonify({
         'grades': [{'subject': g['subject'], 'score': g['score'], 'created_at': g['created_at']} for g in grades],
         'average_score': avg_score,
         'subject_averages': subject_averages
     })
 
+@app.route('/api/analytics/teacher/<id>', methods=['GET'])
+def get_class_analytics(id):
+    teacher = Users.get_by_id(id)
+    if not teacher or teacher['role'] != 'teacher':
+        return jsonify({'message': 'Teacher not found'}), 404
+    return versioned_response(('students', 'grades', 'targets'), lambda: jsonify(analytics.class_report(id)))
+
 @app.route('/api/grades', methods=['GET', 'POST'])
 def manage_grades():
     if request.method == 'GET':
-        grades = Grades.get_all()
-        return jsonify([{'id': g['id'], 'student_id': g['student_id'], 'subject': g['subject'], 'score': g['score'], 'grade': g['grade']} for g in grades])
+        return versioned_response(('grades',), lambda: stream_response(Grades.stream_all(), ('id', 'student_id', 'subject', 'score', 'grade')))
 
     if request.method == 'POST':
         data = request.get_json()
@@ -358,32 +583,103 @@ def manage_grades():
         if grade == "invalid":
             return jsonify({'message': 'Invalid score'}), 400
         grades = Grades.get_by_student(student_id)
-        if len(grades) >= 8:
-            return jsonify({'message': 'Maximum 8 subjects allowed'}), 400
+        if len(grades) >= MAX_GRADES_PER_STUDENT:
+            return jsonify({'message': f'Maximum {MAX_GRADES_PER_STUDENT} subjects allowed'}), 400
         Grades.create(student_id, subject, score, grade)
         notify_user(student_id, f"New grade for {subject}: {grade}")
         notify_user(teacher_id, f"Added grade for {subject}")
         return jsonify({'message': 'Grade added'}), 201
 
+def bulk_grade_rows():
+    """Yield grade dicts from a JSON body, a text/csv body or an uploaded CSV file."""
+    if request.is_json:
+        yield from (request.get_json().get('grades') or [])
+        return
+    if 'file' in request.files:
+        stream = request.files['file'].stream
+    else:
+        stream = request.stream
+    for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+        yield {'studentId': row.get('studentId') or row.get('student_id'), 'subject': row.get('subject'), 'score': row.get('score')}
+
+@app.route('/api/grades/bulk', methods=['POST'])
+def bulk_import_grades():
+    teacher_id = request.args.get('teacher_id') or request.form.get('teacher_id')
+    if request.is_json:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            return jsonify({'message': 'Request body must be a JSON object'}), 400
+        grades = body.get('grades') or []
+        if not isinstance(grades, list) or not all(isinstance(row, dict) for row in grades):
+            return jsonify({'message': 'grades must be a list of objects'}), 400
+        teacher_id = body.get('teacher_id') or teacher_id
+    if not teacher_id:
+        return jsonify({'message': 'Teacher ID cannot be empty'}), 400
+
+    with db_cursor():
+        counts = Grades.count_by_teacher(teacher_id)
+        valid = []
+        errors = []
+        for index, row in enumerate(bulk_grade_rows()):
+            if index >= MAX_BULK_ROWS:
+                errors.append({'row': index, 'message': f'Maximum {MAX_BULK_ROWS} rows per import'})
+                break
+            student_id = row.get('studentId')
+            subject = row.get('subject')
+            score = row.get('score')
+            if not subject or not score:
+                errors.append({'row': index, 'message': 'Subject and score cannot be empty'})
+                continue
+            if not isinstance(subject, str):
+                errors.append({'row': index, 'message': 'Invalid subject'})
+                continue
+            if not isinstance(student_id, str) or student_id not in counts:
+                errors.append({'row': index, 'message': 'Student not in your class'})
+                continue
+            grade = student_grading(score)
+            if grade == "invalid":
+                errors.append({'row': index, 'message': 'Invalid score'})
+                continue
+            if counts[student_id] >= MAX_GRADES_PER_STUDENT:
+                errors.append({'row': index, 'message': f'Maximum {MAX_GRADES_PER_STUDENT} subjects allowed'})
+                continue
+            counts[student_id] += 1
+            valid.append((student_id, subject, int(score), grade))
+        if valid:
+            Grades.create_many(valid)
+
+    for student_id, subject, _, grade in valid:
+        notify_user(student_id, f"New grade for {subject}: {grade}")
+    if valid:
+        notify_user(teacher_id, f"Imported {len(valid)} grades")
+    return jsonify({'inserted': len(valid), 'errors': errors}), 201 if valid else 400
+
 @app.route('/api/assignments', methods=['GET', 'POST'])
 def manage_assignments():
     if request.method == 'GET':
         teacher_id = request.args.get('teacher_id')
         student_id = request.args.get('student_id')
+        try:
+            limit, before, after = page_args()
+        except ValueError:
+            return jsonify({'message': 'Invalid pagination parameters'}), 400
+        if not limit:
+            return stream_response(Assignments.stream(teacher_id or student_id, role='teacher' if teacher_id else 'student'),
+                                   ('id', 'student_id', 'title', 'file_path', 'status', 'created_at'))
         if teacher_id:
-            assignments = Assignments.get_by_user(teacher_id, role='teacher')
+            assignments = Assignments.get_by_user(teacher_id, role='teacher', limit=limit, before=before, after=after)
         elif student_id:
-            assignments = Assignments.get_by_user(student_id, role='student')
+            assignments = Assignments.get_by_user(student_id, role='student', limit=limit, before=before, after=after)
         else:
-            assignments = Assignments.get_all()
-        return jsonify([{
+            assignments = Assignments.get_all(limit=limit, before=before, after=after)
+        return page_response([{
             'id': a['id'],
             'student_id': a['student_id'],
             'title': a['title'],
             'file_path': a['file_path'],
             'status': a['status'],
             'created_at': a['created_at']
-        } for a in assignments])
+        } for a in assignments], assignments, limit, after)
 
     if request.method == 'POST':
         if 'file' not in request.files or not request.form.get('title') or not request.form.get('student_id') or not request.form.get('teacher_id'):
@@ -396,13 +692,14 @@ def manage_assignments():
         if '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
             return jsonify({'message': 'Invalid file type'}), 400
         filename = f"assignment_{student_id}_{uuid.uuid4().hex[:8]}.{file.filename.rsplit('.', 1)[1].lower()}"
-        upload_path = os.path.join('uploads', filename)
         try:
-            file.save(upload_path)
+            storage.save_stream(file.stream, filename, MAX_ASSIGNMENT_BYTES, original_name=file.filename)
             Assignments.create(student_id, teacher_id, title, filename)
             notify_user(student_id, f"Assignment {title} submitted")
             notify_user(teacher_id, f"New assignment {title} from student {student_id}")
             return jsonify({'message': 'Assignment submitted', 'file_path': filename})
+        except storage.UploadTooLarge as e:
+            return jsonify({'message': str(e)}), 413
         except Exception as e:
             return jsonify({'message': f'Upload failed: {str(e)}'}), 500
 
@@ -430,8 +727,7 @@ def add_remark():
 @app.route('/api/chatrooms', methods=['GET', 'POST'])
 def manage_chatrooms():
     if request.method == 'GET':
-        chatrooms = Chatrooms.get_all()
-        return jsonify([{'id': c['id'], 'name': c['name']} for c in chatrooms])
+        return versioned_response(('chatrooms',), lambda: jsonify([{'id': c['id'], 'name': c['name']} for c in Chatrooms.get_all()]))
 
     if request.method == 'POST':
         data = request.get_json()
@@ -458,17 +754,23 @@ def remove_from_chatroom(id):
     data = request.get_json()
     student_id = data.get('studentId')
     ChatroomMembers.remove(id, student_id)
+    evict_from_room(student_id, chatroom_room(id))
     notify_user(student_id, f"Removed from chatroom")
     return jsonify({'message': 'Student removed'})
 
 @app.route('/api/chatrooms/<id>/messages', methods=['GET', 'POST'])
 def manage_messages(id):
     if request.method == 'GET':
-        messages = Messages.get_by_chatroom(id)
+        try:
+            limit, before, after = page_args()
+        except ValueError:
+            return jsonify({'message': 'Invalid pagination parameters'}), 400
+        messages = Messages.get_by_chatroom(id, limit=limit, before=before, after=after)
         members = ChatroomMembers.get_members(id)
         return jsonify({
-            'messages': [{'id': m['id'], 'user_id': m['user_id'], 'content': m['content'], 'type': m['type'], 'created_at': m['created_at']} for m in messages],
-            'members': members
+            'messages': [message_json(m) for m in messages],
+            'members': members,
+            'next_cursor': next_cursor(messages, limit, after)
         })
 
     if request.method == 'POST':
@@ -476,15 +778,18 @@ def manage_messages(id):
         user_id = data.get('user_id')
         content = data.get('content')
         msg_type = data.get('type')
-        Messages.create(id, user_id, content, msg_type)
+        try:
+            message = post_chat_message(id, user_id, content, msg_type)
+        except NotStored as e:
+            # Still queued: it is stored and sent to the room once the database accepts it.
+            return jsonify({'message': 'Message queued', 'id': e.record_id}), 202
         notify_user(user_id, f"New message in chatroom")
-        return jsonify({'message': 'Message sent'}), 201
+        return jsonify({'message': 'Message sent', 'id': message['id']}), 201
 
 @app.route('/api/groups', methods=['GET', 'POST'])
 def manage_groups():
     if request.method == 'GET':
-        groups = Groups.get_all()
-        return jsonify([{'id': g['id'], 'name': g['name']} for g in groups])
+        return versioned_response(('groups',), lambda: jsonify([{'id': g['id'], 'name': g['name']} for g in Groups.get_all()]))
 
     if request.method == 'POST':
         data = request.get_json()
@@ -543,27 +848,51 @@ def set_target():
 @app.route('/api/notifications/<user_id>', methods=['GET', 'PUT'])
 def manage_notifications(user_id):
     if request.method == 'GET':
-        notifications = Notifications.get_by_user(user_id)
-        return jsonify([{'id': n['id'], 'content': n['content'], 'created_at': n['created_at'], 'is_read': n['is_read']} for n in notifications])
+        try:
+            limit, before, after = page_args()
+        except ValueError:
+            return jsonify({'message': 'Invalid pagination parameters'}), 400
+        if not limit:
+            return stream_response(Notifications.stream_by_user(user_id), ('id', 'content', 'created_at', 'is_read'))
+        notifications = Notifications.get_by_user(user_id, limit=limit, before=before, after=after)
+        return page_response([{'id': n['id'], 'content': n['content'], 'created_at': n['created_at'], 'is_read': n['is_read']} for n in notifications],
+                             notifications, limit, after, descending=True)
 
     if request.method == 'PUT':
         data = request.get_json()
         notification_id = data.get('notification_id')
+        if data.get('all') or data.get('up_to'):
+            try:
+                updated = Notifications.mark_all_read(user_id, up_to=data.get('up_to'))
+            except ValueError:
+                return jsonify({'message': 'Invalid cursor'}), 400
+            return jsonify({'message': 'Notifications marked as read', 'updated': updated})
         Notifications.mark_as_read(notification_id, user_id)
         return jsonify({'message': 'Notification marked as read'})
 
+@app.route('/api/notifications/<user_id>/unread_count', methods=['GET'])
+def unread_notification_count(user_id):
+    return jsonify({'unread': Notifications.unread_count(user_id)})
+
 @app.route('/api/private_messages/<user_id>', methods=['GET', 'POST'])
 def manage_private_messages(user_id):
     if request.method == 'GET':
-        messages = PrivateMessages.get_by_user(user_id)
-        return jsonify([{
+        try:
+            limit, before, after = page_args()
+        except ValueError:
+            return jsonify({'message': 'Invalid pagination parameters'}), 400
+        if not limit:
+            return stream_response(PrivateMessages.stream_by_user(user_id),
+                                   ('id', 'sender_id', 'receiver_id', 'content', 'type', 'created_at'))
+        messages = PrivateMessages.get_by_user(user_id, limit=limit, before=before, after=after)
+        return page_response([{
             'id': m['id'],
             'sender_id': m['sender_id'],
             'receiver_id': m['receiver_id'],
             'content': m['content'],
             'type': m['type'],
             'created_at': m['created_at']
-        } for m in messages])
+        } for m in messages], messages, limit, after)
 
     if request.method == 'POST':
         data = request.get_json()
@@ -575,15 +904,168 @@ def manage_private_messages(user_id):
         notify_user(receiver_id, f"New private message from user {sender_id}")
         return jsonify({'message': 'Message sent'}), 201
 
+def token_user():
+    """Return the user whose socket_token is sent as 'Authorization: Bearer <token>', or None."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    try:
+        return Users.get_by_id(socket_tokens.loads(token.strip(), max_age=SOCKET_TOKEN_MAX_AGE))
+    except BadSignature:
+        return None
+
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    """Search the caller's chat messages, private messages and remarks; see search.search()."""
+    user = token_user()
+    if not user:
+        return jsonify({'message': 'Authentication required'}), 401
+    sources = request.args.get('sources')
+    sources = tuple(sources.split(',')) if sources else search.SOURCES
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    if limit < 1 or offset < 0 or request.args.get('sort', 'rank') not in ('rank', 'recent') \
+            or not set(sources) <= set(search.SOURCES):
+        return jsonify({'message': 'Invalid search parameters'}), 400
+    result = search.search(user, request.args.get('q', ''), min(limit, MAX_PAGE_SIZE), offset, sources,
+                           recent=request.args.get('sort') == 'recent')
+    if result is None:
+        return jsonify({'message': 'Search text required'}), 400
+    hits, next_offset = result
+    return jsonify({'items': hits, 'next_offset': next_offset})
+
+@app.cli.command('rebuild-grade-stats')
+def rebuild_grade_stats_command():
+    """Recompute the grade aggregate tables from grades."""
+    GradeStats.rebuild()
+    print('Grade aggregates rebuilt')
+
+@app.cli.command('check-grade-stats')
+def check_grade_stats_command():
+    """Compare the grade aggregate tables against a fresh recomputation."""
+    mismatches = GradeStats.check()
+    for table, count in mismatches.items():
+        print(f'{table}: {count} mismatched rows')
+    if any(mismatches.values()):
+        raise SystemExit(1)
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Check with EXPLAIN QUERY PLAN that the lookup queries search their indexes."""
+    failures = migrations.check_query_plans()
+    for sql, plan in failures:
+        print(f'{sql}\n    ' + '\n    '.join(plan))
+    print(f'{len(migrations.INDEXED_LOOKUPS) - len(failures)}/{len(migrations.INDEXED_LOOKUPS)} lookups use their index')
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the full-text search indexes, e.g. after VACUUM."""
+    counts = search.rebuild()
+    print('Search indexes rebuilt: ' + ', '.join(f'{count} {source}' for source, count in counts.items()))
+
+@app.cli.command('check-search')
+def check_search_command():
+    """Compare the full-text search indexes against their tables."""
+    stale = search.check()
+    for source in stale:
+        print(f'{source}: index out of date, run flask rebuild-search')
+    if stale:
+        raise SystemExit(1)
+
+@app.cli.command('archive-notifications')
+@click.option('--days', default=30, show_default=True, help='Archive read notifications older than this.')
+def archive_notifications_command(days):
+    """Move old read notifications out of the notifications table."""
+    moved = Notifications.archive_read(datetime.now() - timedelta(days=days))
+    print(f'Archived {moved} notifications')
+
+@app.cli.command('seed')
+@click.option('--students', default=1000, show_default=True, help='Number of students; teachers are added to match.')
+@click.option('--students-per-teacher', default=30, show_default=True)
+@click.option('--grades-per-student', default=6, show_default=True)
+@click.option('--messages-per-room', default=200, show_default=True)
+@click.option('--notifications-per-user', default=20, show_default=True)
+@click.option('--password', default='password123', show_default=True, help='Password of every generated account.')
+@click.option('--seed', 'rng_seed', default=42, show_default=True, help='Random seed; the same seed gives the same data.')
+def seed_command(students, students_per_teacher, grades_per_student, messages_per_room, notifications_per_user, password, rng_seed):
+    """Fill the database with a synthetic school for benchmarks."""
+    def progress(written):
+        if written % 1000 < students_per_teacher or written == students:
+            print(f'{written}/{students} students written')
+
+    started = datetime.now()
+    counts = seed.generate(hasher.hash(password), students=students, students_per_teacher=students_per_teacher,
+                           grades_per_student=grades_per_student, messages_per_room=messages_per_room,
+                           notifications_per_user=notifications_per_user, seed=rng_seed, progress=progress)
+    print(', '.join(f'{count} {table}' for table, count in counts.items()) + f' in {(datetime.now() - started).total_seconds():.1f}s')
+
+@app.cli.command('import-uploads')
+def import_uploads_command():
+    """Move legacy files in uploads/ into content-addressed storage."""
+    imported, duplicates = storage.import_legacy()
+    print(f'Imported {imported} files ({duplicates} duplicates of existing content)')
+
 @socketio.on('connect')
-def handle_connect():
-    print('Client connected')
+def handle_connect(auth=None):
+    """Join the caller's private room when they present a valid socket_token."""
+    token = (auth or {}).get('token')
+    if not token:
+        print('Client connected')
+        return
+    try:
+        user_id = socket_tokens.loads(token, max_age=SOCKET_TOKEN_MAX_AGE)
+    except BadSignature:
+        return False
+    session['user_id'] = user_id
+    join_room(user_room(user_id))
+    print(f'Client connected as {user_id}')
+
+@socketio.on('join_chatroom')
+def handle_join_chatroom(data):
+    user_id = session.get('user_id')
+    chatroom_id = (data or {}).get('chatroom_id')
+    chatroom = Chatrooms.get_by_id(chatroom_id)
+    if not user_id or not chatroom:
+        return {'ok': False}
+    if chatroom['teacher_id'] != user_id and user_id not in ChatroomMembers.get_members(chatroom_id):
+        return {'ok': False}
+    join_room(chatroom_room(chatroom_id))
+    recent = Messages.get_by_chatroom(chatroom_id, limit=CHAT_HISTORY_ON_JOIN)
+    return {'ok': True, 'recent': [message_json(m) for m in recent]}
+
+@socketio.on('send_message')
+def handle_send_message(data):
+    """Post a chat message from a socket that has joined the room."""
+    data = data or {}
+    user_id = session.get('user_id')
+    chatroom_id = data.get('chatroom_id')
+    content = data.get('content')
+    if not user_id or chatroom_room(chatroom_id) not in rooms():
+        return {'ok': False, 'message': 'Join the chatroom first'}
+    if not content:
+        return {'ok': False, 'message': 'Message cannot be empty'}
+    try:
+        message = post_chat_message(chatroom_id, user_id, content, data.get('type') or 'text')
+    except NotStored as e:
+        return {'ok': False, 'queued': True, 'id': e.record_id, 'message': 'Message not saved yet; it will be sent once it is'}
+    return {'ok': True, 'id': message['id']}
+
+@socketio.on('leave_chatroom')
+def handle_leave_chatroom(data):
+    leave_room(chatroom_room((data or {}).get('chatroom_id')))
+    return {'ok': True}
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
 
+init_db()  # Idempotent; runs under gunicorn too, which never executes __main__
+
 if __name__ == '__main__':
-    os.makedirs('uploads', exist_ok=True)
-    init_db()  # Initialize database on startup
+    os.makedirs(storage.UPLOAD_DIR, exist_ok=True)
     socketio.run(app, debug=True)
\ No newline at end of file
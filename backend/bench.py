@@ -0,0 +1,453 @@
+"""Benchmark the API against a seeded database and save the results for later comparison.
+
+    flask --app app seed --students 10000          # once, see seed.py
+    python bench.py --db grade_manager.db --save
+    python bench.py --db grade_manager.db --url http://127.0.0.1:5000 --concurrency 16 --compare bench-results/<file>.json
+
+Without --url, requests go through Flask's test client in this process, which
+measures the server's own cost. With --url they go over HTTP (and Socket.IO)
+to a running server. Each scenario reports p50/p90/p99/max latency and
+throughput. --compare prints the change against a saved run and exits with
+status 1 when a scenario's p99 or throughput regressed more than --threshold.
+"""
+import argparse
+import http.client
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+SCENARIOS = ('students', 'trends', 'chat_history', 'notifications', 'login', 'socket_send', 'socket_connect')
+# Only run when named with --scenario. The grade scenarios add a throwaway class and its grades to --db.
+GRADE_SCENARIOS = ('grade_single', 'grade_bulk', 'grade_csv')
+# GETs of one stored upload: the whole body, a revalidation by ETag, and the first 64 KB. Expected status of each.
+UPLOAD_SCENARIOS = {'upload_full': 200, 'upload_revalidate': 304, 'upload_range': 206}
+UPLOAD_BYTES = 256 * 1024
+# Inserts into an empty messages table keyed by random uuid4 or time-ordered new_id() ids; no server involved.
+ID_SCENARIOS = ('ids_uuid4', 'ids_uuid7')
+EXTRA_SCENARIOS = ('students_query', 'students_loop') + GRADE_SCENARIOS + tuple(UPLOAD_SCENARIOS) + ID_SCENARIOS
+# These call the model directly, so they need the in-process app.
+IN_PROCESS_SCENARIOS = ('students_query', 'students_loop')
+# Logins are dominated by password hashing, so they get fewer requests.
+SLOW_SCENARIOS = {'login': 50, 'socket_connect': 200, 'students_loop': 5, 'grade_bulk': 50, 'grade_csv': 50}
+
+def load_targets(db_path, limit=2000):
+    """Pick ids to request from the seeded database."""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    targets = {
+        'students': [r['id'] for r in conn.execute('SELECT id FROM students ORDER BY id LIMIT ?', (limit,))],
+        'users': [r['id'] for r in conn.execute('SELECT id FROM users ORDER BY id LIMIT ?', (limit,))],
+        'logins': [r['email'] for r in conn.execute("SELECT email FROM users WHERE email LIKE '%@school.test' ORDER BY email LIMIT ?", (limit,))],
+        'rooms': [(r['id'], r['teacher_id']) for r in conn.execute('SELECT id, teacher_id FROM chatrooms ORDER BY id LIMIT ?', (limit,))],
+    }
+    sizes = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+             for table in ('users', 'students', 'grades', 'chatrooms', 'messages', 'notifications')}
+    conn.close()
+    if not targets['students'] or not targets['rooms']:
+        sys.exit(f'{db_path} has no seeded data; run `flask --app app seed` first')
+    return targets, sizes
+
+def http_request(scenario, targets, rng, password):
+    """Return (method, path, json body) for one request of an HTTP scenario."""
+    if scenario == 'students':
+        return 'GET', '/api/students', None
+    if scenario == 'trends':
+        return 'GET', f"/api/students/{rng.choice(targets['students'])}/trends", None
+    if scenario == 'chat_history':
+        return 'GET', f"/api/chatrooms/{rng.choice(targets['rooms'])[0]}/messages?limit=50", None
+    if scenario == 'notifications':
+        return 'GET', f"/api/notifications/{rng.choice(targets['users'])}?limit=50", None
+    if scenario == 'login':
+        email = rng.choice(targets['logins'])
+        return 'POST', '/api/login', {'email': email, 'password': password,
+                                      'role': 'teacher' if email.startswith('teacher') else 'student'}
+    raise ValueError(scenario)
+
+def make_class(students):
+    """Write a teacher with `students` new students to the database and return (teacher_id, student_ids)."""
+    from model import Users, Students, db_cursor
+    tag = f'{time.time_ns():x}'
+    student_ids = []
+    with db_cursor():
+        # '!' is no valid password hash, so nobody can log in as these accounts.
+        teacher_id = Users.create(f'Bench teacher {tag}', f'bench-{tag}@bench.test', '!', 'teacher')
+        for n in range(students):
+            email = f'bench-{tag}-{n}@bench.test'
+            student_id = Users.create(f'Bench student {n}', email, '!', 'student')
+            Students.create(student_id, f'Bench student {n}', email, teacher_id)
+            student_ids.append(student_id)
+    return teacher_id, student_ids
+
+def grade_request(scenario, teacher_id, slots, rng):
+    """Return (method, path, body, headers) adding a grade for each (student_id, subject) slot."""
+    grades = [{'studentId': student_id, 'subject': subject, 'score': rng.randint(1, 100)} for student_id, subject in slots]
+    if scenario == 'grade_single':
+        return 'POST', '/api/grades', dict(grades[0], teacher_id=teacher_id), None
+    if scenario == 'grade_bulk':
+        return 'POST', '/api/grades/bulk', {'teacher_id': teacher_id, 'grades': grades}, None
+    body = 'studentId,subject,score\n' + ''.join(f"{g['studentId']},{g['subject']},{g['score']}\n" for g in grades)
+    return 'POST', f'/api/grades/bulk?teacher_id={teacher_id}', body, {'Content-Type': 'text/csv'}
+
+def make_upload(size):
+    """Store `size` random bytes as an upload and return (filename, sha256); storage.release() removes it."""
+    import storage
+    filename = f'bench_{time.time_ns():x}.pdf'
+    return filename, storage.save_stream(io.BytesIO(os.urandom(size)), filename, size, original_name=filename)
+
+def upload_request(scenario, filename, sha256):
+    """Return (method, path, body, headers) for one request of an upload scenario."""
+    headers = None
+    if scenario == 'upload_revalidate':
+        headers = {'If-None-Match': f'"{sha256}"'}
+    elif scenario == 'upload_range':
+        headers = {'Range': 'bytes=0-65535'}
+    return 'GET', f'/uploads/{filename}', None, headers
+
+def students_query():
+    """The student list from get_all_with_general_grade(), without the response cache in front of it."""
+    from model import Students
+    return json.dumps([dict(row) for row in Students.get_all_with_general_grade()])
+
+def students_loop():
+    """The student list as GET /api/students built it before get_all_with_general_grade(): one query per student."""
+    from model import Students, Grades, student_grading
+    result = []
+    for student in Students.get_all():
+        grades = Grades.get_by_student(student['id'])
+        general_grade = student_grading(sum(g['score'] for g in grades[:7]) / min(len(grades), 7)) if grades else 'E'
+        result.append(dict(student, general_grade=general_grade))
+    result.sort(key=lambda x: {'A': 5, 'B': 4, 'C': 3, 'D': 2, 'E': 1}.get(x['general_grade'], 1), reverse=True)
+    return json.dumps(result)
+
+class InProcessClient:
+    """Calls the app through Flask's test client and Flask-SocketIO's test client."""
+    def __init__(self, app_module):
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+        self.received = 0
+
+    def request(self, method, path, body, headers=None):
+        if isinstance(body, str):
+            response = self.client.open(path, method=method, data=body, headers=headers)
+        else:
+            response = self.client.open(path, method=method, json=body, headers=headers)
+        self.received += len(response.get_data())
+        return response.status_code, response.get_json(silent=True)
+
+    def socket(self, token):
+        return InProcessSocket(self.app_module, token)
+
+class InProcessSocket:
+    def __init__(self, app_module, token):
+        self.client = app_module.socketio.test_client(app_module.app, auth={'token': token})
+
+    def call(self, event, data):
+        return self.client.emit(event, data, callback=True)
+
+    def close(self):
+        self.client.disconnect()
+
+class HttpClient:
+    """Keeps one HTTP connection per benchmark thread to a running server."""
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.received = 0
+
+    def request(self, method, path, body, headers=None):
+        if body is not None and not isinstance(body, str):
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+            body = json.dumps(body)
+        self.conn.request(method, path, body=body, headers=headers or {})
+        response = self.conn.getresponse()
+        data = response.read()
+        self.received += len(data)
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+    def socket(self, token):
+        return HttpSocket(self.url, token)
+
+class HttpSocket:
+    def __init__(self, url, token):
+        import socketio
+        self.client = socketio.Client()
+        self.client.connect(url, transports=['websocket'], auth={'token': token})
+
+    def call(self, event, data):
+        return self.client.call(event, data, timeout=30)
+
+    def close(self):
+        self.client.disconnect()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def summarize(latencies, errors, wall):
+    latencies = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p90_ms': ms(percentile(latencies, 90)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else 0),
+        'throughput_rps': round(len(latencies) / wall, 1) if wall else 0.0,
+    }
+
+def run_id_scenario(scenario, args):
+    """Insert --id-rows messages into an empty database in --id-batch transactions; each batch is one request.
+
+    Random uuid4 keys land on random pages of the primary-key index, which
+    slows inserts down once the index outgrows SQLite's page cache. Only the
+    inserts are timed. Besides the usual figures this reports the rate over
+    the last tenth of the batches, the file size and the primary-key index size.
+    """
+    import uuid
+    from model import SQLITE_PRAGMAS, new_id
+    make_id = (lambda: str(uuid.uuid4())) if scenario == 'ids_uuid4' else new_id
+    rng = random.Random(args.seed)
+    rooms = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(1000)]
+    texts = [' '.join(rng.choice(('homework', 'exam', 'notes', 'deadline', 'quiz', 'thanks')) for _ in range(n))
+             for n in range(3, 15)]
+    latencies = []
+    with tempfile.TemporaryDirectory(prefix='bench-ids-') as tmp:
+        path = os.path.join(tmp, 'ids.db')
+        conn = sqlite3.connect(path)
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        conn.execute('CREATE TABLE messages (id TEXT PRIMARY KEY, chatroom_id TEXT, user_id TEXT, content TEXT, '
+                     'type TEXT, created_at TIMESTAMP)')
+        conn.execute('CREATE INDEX idx_messages_chatroom_created ON messages (chatroom_id, created_at)')
+        for done in range(0, args.id_rows, args.id_batch):
+            now = datetime.now()
+            batch = [(make_id(), rng.choice(rooms), rng.choice(rooms), rng.choice(texts), 'text', now)
+                     for _ in range(min(args.id_batch, args.id_rows - done))]
+            started = time.perf_counter()
+            conn.executemany('INSERT INTO messages (id, chatroom_id, user_id, content, type, created_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            conn.commit()
+            latencies.append(time.perf_counter() - started)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        pk_bytes = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'sqlite_autoindex_messages_1'").fetchone()[0]
+        conn.close()
+        file_bytes = os.path.getsize(path)
+    summary = summarize(latencies, 0, sum(latencies))
+    last = latencies[-max(1, len(latencies) // 10):]
+    summary.update(rows_per_s=round(args.id_rows / sum(latencies), 1),
+                   final_rows_per_s=round(len(last) * args.id_batch / sum(last), 1),
+                   db_mb=round(file_bytes / 2**20, 1), pk_mb=round((pk_bytes or 0) / 2**20, 1))
+    return summary
+
+def run_scenario(scenario, make_client, targets, args, tokens):
+    """Run one scenario on args.concurrency threads and return its summary."""
+    count = min(args.requests, SLOW_SCENARIOS.get(scenario, args.requests))
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [count + args.warmup * args.concurrency]
+    rows_per_request = 1
+    if scenario in GRADE_SCENARIOS:
+        from seed import SUBJECTS
+        if scenario != 'grade_single':
+            rows_per_request = args.bulk_rows
+        # Enough students that no grade hits the per-student subject cap.
+        class_teacher, class_students = make_class(-(-remaining[0] * rows_per_request // len(SUBJECTS)))
+        slots = iter([(student_id, subject) for student_id in class_students for subject in SUBJECTS])
+    if scenario in UPLOAD_SCENARIOS:
+        filename, sha256 = make_upload(UPLOAD_BYTES)
+    received = [0]
+
+    def take():
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    def worker(n):
+        rng = random.Random(f'{args.seed}-{scenario}-{n}')
+        client = make_client()
+        socket = None
+        room_id, teacher_id = rng.choice(targets['rooms'])
+        if scenario == 'socket_send':
+            socket = client.socket(tokens[teacher_id])
+            socket.call('join_chatroom', {'chatroom_id': room_id})
+        done = 0
+        while take():
+            before = getattr(client, 'received', 0)
+            started = time.perf_counter()
+            try:
+                if scenario == 'socket_send':
+                    ok = (socket.call('send_message', {'chatroom_id': room_id, 'content': 'bench'}) or {}).get('ok')
+                elif scenario in GRADE_SCENARIOS:
+                    with lock:
+                        rows = list(itertools.islice(slots, rows_per_request))
+                    status, _ = client.request(*grade_request(scenario, class_teacher, rows, rng))
+                    ok = status < 400
+                elif scenario in UPLOAD_SCENARIOS:
+                    status, _ = client.request(*upload_request(scenario, filename, sha256))
+                    ok = status == UPLOAD_SCENARIOS[scenario]
+                elif scenario == 'students_query':
+                    ok = bool(students_query())
+                elif scenario == 'students_loop':
+                    ok = bool(students_loop())
+                elif scenario == 'socket_connect':
+                    s = client.socket(tokens[teacher_id])
+                    ok = (s.call('join_chatroom', {'chatroom_id': room_id}) or {}).get('ok')
+                    s.close()
+                else:
+                    status, _ = client.request(*http_request(scenario, targets, rng, args.password))
+                    ok = status < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            done += 1
+            if done <= args.warmup:
+                continue
+            with lock:
+                latencies.append(elapsed)
+                received[0] += getattr(client, 'received', 0) - before
+                if not ok:
+                    errors[0] += 1
+        if socket is not None:
+            socket.close()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    if scenario in UPLOAD_SCENARIOS:
+        import storage
+        storage.release(filename)
+    summary = summarize(latencies, errors[0], wall)
+    if scenario in UPLOAD_SCENARIOS:
+        summary['bytes_per_request'] = round(received[0] / len(latencies)) if latencies else 0
+    if rows_per_request > 1 or scenario in GRADE_SCENARIOS:
+        summary['rows_per_s'] = round(summary['throughput_rps'] * rows_per_request, 1)
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline, threshold):
+    """Print the change of each scenario against a saved run; return the regressed scenario names."""
+    regressed = []
+    print(f"\nAgainst {baseline['meta'].get('revision')} ({baseline['meta'].get('started')}):")
+    for scenario, now in results.items():
+        before = baseline['results'].get(scenario)
+        if not before:
+            continue
+        change = lambda key: (now[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        p99, rps = change('p99_ms'), change('throughput_rps')
+        flag = ''
+        if p99 > threshold or rps < -threshold:
+            regressed.append(scenario)
+            flag = '  REGRESSION'
+        print(f'  {scenario:17} p50 {change("p50_ms"):+6.1f}%  p99 {p99:+6.1f}%  throughput {rps:+6.1f}%{flag}')
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=os.environ.get('DB_PATH', 'grade_manager.db'), help='Seeded database')
+    parser.add_argument('--url', help='Benchmark a running server instead of an in-process app')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS + EXTRA_SCENARIOS,
+                        help='Run only these (repeatable); the default is every scenario but ' + ', '.join(EXTRA_SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='Unrecorded requests per thread first')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--bulk-rows', type=int, default=200, help='Grades per grade_bulk/grade_csv request')
+    parser.add_argument('--id-rows', type=int, default=1_000_000, help='Rows inserted by ids_uuid4/ids_uuid7')
+    parser.add_argument('--id-batch', type=int, default=10_000, help='Rows per transaction in ids_uuid4/ids_uuid7')
+    parser.add_argument('--password', default='password123', help='Password the data was seeded with')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', action='store_true', help='Write the results to --out')
+    parser.add_argument('--out', default='bench-results')
+    parser.add_argument('--compare', help='Saved results to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='Regression threshold in percent')
+    args = parser.parse_args()
+
+    targets, sizes = load_targets(args.db)
+    # Scenarios that set up data write it through the model, so against --url this must be the server's database.
+    os.environ['DB_PATH'] = os.path.abspath(args.db)
+    # The test clients are synchronous; gevent would only add scheduling noise.
+    os.environ.setdefault('ASYNC_MODE', 'threading')
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        signer_module = None
+    else:
+        import app as app_module
+        make_client = lambda: InProcessClient(app_module)
+        signer_module = app_module
+    if signer_module is None:
+        # Socket tokens are signed with the server's SECRET_KEY, which must be exported here too.
+        from itsdangerous import URLSafeTimedSerializer
+        signer = URLSafeTimedSerializer(os.environ.get('SECRET_KEY', ''), salt='socket-auth')
+    else:
+        signer = signer_module.socket_tokens
+    tokens = {teacher_id: signer.dumps(teacher_id) for _, teacher_id in targets['rooms']}
+
+    meta = {
+        'started': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'mode': args.url or 'in-process',
+        'concurrency': args.concurrency,
+        'python': platform.python_version(),
+        'dataset': sizes,
+    }
+    print(f"{meta['mode']}, concurrency {args.concurrency}, dataset " + ', '.join(f'{n} {t}' for t, n in sizes.items()))
+    results = {}
+    for scenario in args.scenario or SCENARIOS:
+        if scenario in IN_PROCESS_SCENARIOS and args.url:
+            print(f'  {scenario:17} skipped: runs in-process only')
+            continue
+        if scenario.startswith('socket') and args.url and not os.environ.get('SECRET_KEY'):
+            print(f'  {scenario:17} skipped: export the server\'s SECRET_KEY to sign socket tokens')
+            continue
+        if scenario in ID_SCENARIOS:
+            results[scenario] = r = run_id_scenario(scenario, args)
+        else:
+            results[scenario] = r = run_scenario(scenario, make_client, targets, args, tokens)
+        print(f"  {scenario:17} p50 {r['p50_ms']:8.2f} ms  p90 {r['p90_ms']:8.2f}  p99 {r['p99_ms']:8.2f}  "
+              f"max {r['max_ms']:8.2f}  {r['throughput_rps']:8.1f} req/s  errors {r['errors']}/{r['requests']}"
+              + (f"  {r['rows_per_s']:.0f} rows/s" if 'rows_per_s' in r else '')
+              + (f"  {r['bytes_per_request']} bytes/request" if 'bytes_per_request' in r else '')
+              + (f"  last tenth {r['final_rows_per_s']:.0f} rows/s, file {r['db_mb']} MB, pk index {r['pk_mb']} MB"
+                 if 'db_mb' in r else ''))
+
+    if args.save:
+        os.makedirs(args.out, exist_ok=True)
+        path = os.path.join(args.out, f"{meta['started'].replace(':', '')}-{meta['revision'] or 'local'}.json")
+        with open(path, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f'Saved {path}')
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Check that several worker processes see each other's events through one message queue.
+
+    python check_workers.py --workers 4 --events 500
+    python check_workers.py --queue redis://localhost:6379/0
+
+Each worker is a process that imports app with SOCKETIO_MESSAGE_QUEUE set,
+as a gunicorn worker does. With a local:// queue this script runs the
+LocalBroker, like gunicorn's master. Once every worker hears every other one,
+each worker publishes --events app-level broadcasts, Socket.IO emits to a
+room and chat messages, then waits to receive what the other workers
+published. The check passes only if every worker received all of them and its
+cached chat history matches the database. Exits with status 1 otherwise.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOM = 'check-room'
+
+def worker(number, workers, events, barrier, results):
+    import app
+    import model
+
+    manager = app.socket_manager
+    received = {'broadcasts': 0, 'emits': 0}
+    heard = set()
+    manager.on('hello', heard.add)
+    manager.on('check', lambda sender, seq: received.__setitem__('broadcasts', received['broadcasts'] + 1))
+    handle_emit = manager._handle_emit
+
+    def count_emit(message):
+        # emit() also hands this worker's own emits to _handle_emit; count only the other workers'.
+        if message.get('event') == 'check' and message.get('host_id') != manager.host_id:
+            received['emits'] += 1
+        handle_emit(message)
+    manager._handle_emit = count_emit
+
+    # Keep greeting until every worker has heard all the others, so no listener is still connecting.
+    greeted = threading.Event()
+
+    def greet():
+        while not greeted.is_set():
+            manager.broadcast('hello', number)
+            greeted.wait(0.05)
+    threading.Thread(target=greet, daemon=True).start()
+    deadline = time.monotonic() + 30
+    while len(heard) < workers - 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        if len(heard) < workers - 1:
+            barrier.abort()
+        barrier.wait(timeout=max(deadline - time.monotonic(), 0.1))
+    except threading.BrokenBarrierError:
+        results.put({'worker': number, 'error': f'heard only workers {sorted(heard)}'})
+        return
+    finally:
+        greeted.set()
+
+    model.Messages.get_by_chatroom(ROOM)  # load the room so later appends are cached
+    started = time.perf_counter()
+    for seq in range(events):
+        manager.broadcast('check', number, seq)
+        app.socketio.emit('check', {'worker': number, 'seq': seq}, to=ROOM)
+        model.Messages.create(ROOM, f'worker-{number}', f'message {seq}', 'text')
+    expected = events * (workers - 1)
+    while min(received.values()) < expected and time.perf_counter() - started < 30:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    time.sleep(0.2)  # let the last cache appends land
+    cached = {m['id'] for m in model.Messages.get_by_chatroom(ROOM)}
+    with model.db_cursor() as c:
+        c.execute('SELECT id FROM messages WHERE chatroom_id = ?', (ROOM,))
+        stored = {row[0] for row in c.fetchall()}
+    results.put(dict(received, worker=number, expected=expected, elapsed=elapsed,
+                     cache_matches=cached == stored, stored=len(stored)))
+
+def run(workers, events, queue, db_path):
+    """Start the workers on queue against db_path, which must be migrated, and return their reports."""
+    env = dict(SOCKETIO_MESSAGE_QUEUE=queue, DB_PATH=db_path, ASYNC_MODE='threading',
+               CHAT_CACHE_MESSAGES=str(events * workers + 1), SECRET_KEY='check-workers')
+    saved = {name: os.environ.get(name) for name in env}
+    broker = None
+    if queue.startswith('local://'):
+        from pubsub import LocalBroker
+        broker = LocalBroker(queue[len('local://'):]).start()
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(n, workers, events, barrier, results))
+                 for n in range(workers)]
+    # Spawned workers copy the environment when they start.
+    os.environ.update(env)
+    try:
+        for p in processes:
+            p.start()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    reports = []
+    for _ in processes:
+        try:
+            reports.append(results.get(timeout=120))
+        except Exception:
+            break
+    for p in processes:
+        p.join(timeout=10)
+        if p.is_alive():
+            p.terminate()
+    if broker is not None:
+        broker.close()
+    return sorted(reports, key=lambda r: r['worker'])
+
+def summarize(reports, workers):
+    """Return (lines to print, whether the check failed)."""
+    lines = []
+    failed = len(reports) < workers
+    for r in reports:
+        if 'error' in r:
+            lines.append(f"worker {r['worker']}: {r['error']}")
+            failed = True
+            continue
+        ok = r['broadcasts'] == r['emits'] == r['expected'] and r['cache_matches']
+        failed |= not ok
+        rate = (r['broadcasts'] + r['emits']) / r['elapsed']
+        lines.append(f"worker {r['worker']}: {r['broadcasts']}/{r['expected']} broadcasts, "
+                     f"{r['emits']}/{r['expected']} emits, chat cache "
+                     f"{'matches' if r['cache_matches'] else 'differs from'} {r['stored']} stored messages, "
+                     f"{rate:.0f} deliveries/s{'' if ok else '  FAILED'}")
+    if len(reports) < workers:
+        lines.append(f'{workers - len(reports)} workers did not report')
+    return lines, failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--events', type=int, default=500, help='Events of each kind published by each worker')
+    parser.add_argument('--queue', help='SOCKETIO_MESSAGE_QUEUE to test (default: a LocalBroker on a temp socket)')
+    args = parser.parse_args()
+    if args.workers < 2:
+        sys.exit('--workers must be at least 2')
+
+    tmp = tempfile.mkdtemp(prefix='check-workers-')
+    queue = args.queue or f'local://{tmp}/socketio.sock'
+    db_path = os.path.join(tmp, 'check.db')
+    os.environ.update(DB_PATH=db_path, ASYNC_MODE='threading')
+    import migrations
+    migrations.upgrade()
+
+    lines, failed = summarize(run(args.workers, args.events, queue, db_path), args.workers)
+    print('\n'.join(lines))
+    print('FAILED' if failed else f'OK: {args.workers} workers on {queue.split("://")[0]}')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
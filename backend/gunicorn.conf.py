@@ -0,0 +1,44 @@
+"""Production gunicorn settings: gevent workers serving HTTP and websockets on one event loop.
+
+Run with `gunicorn -c gunicorn.conf.py app:app`.
+
+Socket.IO keeps each connection's state in the worker that accepted it. To run
+more than one worker:
+
+* set SOCKETIO_MESSAGE_QUEUE so emits, room changes and cache updates reach
+  every worker (redis://... across hosts, local:///path/to.sock on one host;
+  the local broker is started here in the master);
+* keep each client on one worker. gunicorn balances every request on its own,
+  so under WEB_CONCURRENCY > 1 clients must use the websocket transport only
+  (the frontend does). Clients that need long-polling require one gunicorn
+  per port behind a proxy with sticky sessions (nginx `ip_hash`, or a cookie
+  affinity rule on the load balancer).
+"""
+import os
+import sys
+
+# Socket tokens and sessions are signed with SECRET_KEY. A generated key would
+# differ per worker and change on every restart, logging every user out.
+if not os.environ.get('SECRET_KEY'):
+    sys.exit('SECRET_KEY must be set: socket tokens and sessions are signed with it')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Open sockets (HTTP keep-alive and websockets) one worker may hold.
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+def on_starting(server):
+    """Start the single-host message broker before any worker connects to it."""
+    queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE', '')
+    if queue.startswith('local://'):
+        from pubsub import LocalBroker
+        server.pubsub_broker = LocalBroker(queue[len('local://'):]).start()
+
+def on_exit(server):
+    broker = getattr(server, 'pubsub_broker', None)
+    if broker is not None:
+        broker.close()
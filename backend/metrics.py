@@ -0,0 +1,186 @@
+"""Request and SQL instrumentation, served on /metrics in the Prometheus text format.
+
+Every Flask request records its latency, its SQL statement count and its
+time spent in SQLite, labelled by route. Statements slower than
+SLOW_QUERY_MS are logged together with their EXPLAIN QUERY PLAN, and
+requests running more than QUERY_ALERT statements (usually an N+1 loop) are
+logged too. With PROFILE_SAMPLE_RATE > 0 that fraction of requests runs
+under cProfile and is written to PROFILE_DIR.
+
+Numbers are per worker process; scrape each worker (or run one) to see them all.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+try:
+    from gevent.local import local as _local
+except ImportError:
+    from threading import local as _local
+
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+# Optional bearer token for GET /metrics.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+QUERY_ALERT = int(os.environ.get('QUERY_ALERT', 50))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+SLOW_QUERY_LOG_SIZE = 100
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._series.items())
+        for label_values, (counts, total, count) in items:
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), label_values + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{labels} {total:.6f}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f'{self.name}{_labels(self.labels, k)} {v}' for k, v in items)
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+requests_total = Counter('http_requests_total', 'HTTP requests served.', ('method', 'route', 'status'))
+request_seconds = Histogram('http_request_duration_seconds', 'HTTP request latency.', ('method', 'route'), LATENCY_BUCKETS)
+request_queries = Histogram('http_request_sql_queries', 'SQL statements run per HTTP request.', ('method', 'route'), QUERY_COUNT_BUCKETS)
+request_db_seconds = Histogram('http_request_db_seconds', 'Time spent in SQLite per HTTP request.', ('method', 'route'), LATENCY_BUCKETS)
+query_alerts = Counter('http_request_sql_query_alerts_total', f'Requests that ran more than {QUERY_ALERT} SQL statements.', ('method', 'route'))
+query_seconds = Histogram('db_query_duration_seconds', 'SQL statement latency, fetches included.', (), LATENCY_BUCKETS)
+slow_queries_total = Counter('db_slow_queries_total', f'SQL statements slower than {SLOW_QUERY_MS:g} ms.')
+
+# Recent slow statements: dicts with sql, seconds, plan and route.
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+_request = _local()
+
+def observe_query(conn, sql, params, seconds):
+    """model.query_observer: account one finished statement to the process and the current request."""
+    query_seconds.observe(seconds)
+    state = getattr(_request, 'state', None)
+    if state is not None:
+        state['queries'] += 1
+        state['db_seconds'] += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        slow_queries_total.inc()
+        plan = explain(conn, sql, params)
+        route = state['route'] if state is not None else None
+        slow_queries.append({'sql': sql, 'seconds': seconds, 'plan': plan, 'route': route})
+        print(f'Slow query ({seconds * 1000:.1f} ms, {route or "no request"}): {" ".join(sql.split())}')
+        for line in plan:
+            print(f'    {line}')
+
+def explain(conn, sql, params):
+    """Return the EXPLAIN QUERY PLAN lines of a statement, or [] if it can't be explained."""
+    if params and isinstance(params, (list, tuple)) and isinstance(params[0], (list, tuple)):
+        params = params[0]  # executemany: the plan is the same for every row
+    try:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()]
+    except Exception:
+        return []
+
+def start_request(route):
+    state = {'route': route, 'started': time.perf_counter(), 'queries': 0, 'db_seconds': 0.0, 'profiler': None}
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        state['profiler'] = cProfile.Profile()
+        state['profiler'].enable()
+    _request.state = state
+
+def finish_request(method, status):
+    """Record the current request; return its state (route, queries, db_seconds, seconds) or None."""
+    state = getattr(_request, 'state', None)
+    if state is None:
+        return None
+    _request.state = None
+    state['seconds'] = time.perf_counter() - state['started']
+    route = state['route']
+    requests_total.inc(method, route, status)
+    request_seconds.observe(state['seconds'], method, route)
+    request_queries.observe(state['queries'], method, route)
+    request_db_seconds.observe(state['db_seconds'], method, route)
+    if state['queries'] > QUERY_ALERT:
+        query_alerts.inc(method, route)
+        print(f'{method} {route} ran {state["queries"]} SQL statements ({state["db_seconds"] * 1000:.1f} ms in SQLite)')
+    if state['profiler'] is not None:
+        state['profiler'].disable()
+        _save_profile(state['profiler'], method, route)
+    return state
+
+def _save_profile(profiler, method, route):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{method}{route.replace('/', '_').replace('<', '').replace('>', '')}-{time.time():.6f}.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+
+def gauges(name, values, help):
+    """Render a stats() dict's numeric values as gauges named <name>_<key>."""
+    lines = []
+    for key, value in sorted(values.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        metric = f'{name}_{key}'
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} gauge', f'{metric} {value}']
+    return lines
+
+def render(extra=()):
+    """Return the exposition text: request/SQL metrics followed by `extra` (name, stats dict, help) gauges."""
+    lines = []
+    for metric in (requests_total, request_seconds, request_queries, request_db_seconds, query_alerts,
+                   query_seconds, slow_queries_total):
+        lines += metric.render()
+    for name, values, help in extra:
+        lines += gauges(name, values, help)
+    return '\n'.join(lines) + '\n'
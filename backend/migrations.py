@@ -0,0 +1,483 @@
+"""Versioned schema migrations for the grade manager database."""
+from datetime import datetime
+import model
+
+# Each migration is (version, description, steps). A step is either a SQL
+# statement or a callable taking the cursor. Append new migrations at the end;
+# never edit one that has already shipped.
+BASE_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        email TEXT UNIQUE,
+        password TEXT,
+        role TEXT,
+        bio TEXT,
+        profile_photo TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS students (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        email TEXT,
+        teacher_id TEXT,
+        profile_photo TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS grades (
+        id TEXT PRIMARY KEY,
+        student_id TEXT,
+        subject TEXT,
+        score INTEGER,
+        grade TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS chatrooms (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        teacher_id TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS chatroom_members (
+        chatroom_id TEXT,
+        user_id TEXT,
+        PRIMARY KEY (chatroom_id, user_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        chatroom_id TEXT,
+        user_id TEXT,
+        content TEXT,
+        type TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS groups (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        teacher_id TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS group_members (
+        group_id TEXT,
+        user_id TEXT,
+        PRIMARY KEY (group_id, user_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS targets (
+        id TEXT PRIMARY KEY,
+        student_id TEXT,
+        subject TEXT,
+        target INTEGER,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS remarks (
+        id TEXT PRIMARY KEY,
+        student_id TEXT,
+        teacher_id TEXT,
+        content TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS notifications (
+        id TEXT PRIMARY KEY,
+        user_id TEXT,
+        content TEXT,
+        created_at TIMESTAMP,
+        is_read INTEGER DEFAULT 0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS private_messages (
+        id TEXT PRIMARY KEY,
+        sender_id TEXT,
+        receiver_id TEXT,
+        content TEXT,
+        type TEXT,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS assignments (
+        id TEXT PRIMARY KEY,
+        student_id TEXT,
+        teacher_id TEXT,
+        title TEXT,
+        file_path TEXT,
+        status TEXT,
+        created_at TIMESTAMP
+    )''',
+)
+
+LOOKUP_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_students_teacher ON students (teacher_id)',
+    'CREATE INDEX IF NOT EXISTS idx_grades_student_created ON grades (student_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_chatroom_created ON messages (chatroom_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_targets_student ON targets (student_id)',
+    'CREATE INDEX IF NOT EXISTS idx_remarks_student_created ON remarks (student_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications (user_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_private_messages_sender_created ON private_messages (sender_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_private_messages_receiver_created ON private_messages (receiver_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_assignments_student_created ON assignments (student_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_assignments_teacher_created ON assignments (teacher_id, created_at)',
+    'ANALYZE',
+)
+
+GRADE_STATS_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS student_grade_stats (
+        student_id TEXT PRIMARY KEY,
+        grade_count INTEGER NOT NULL,
+        score_sum INTEGER NOT NULL,
+        score_min INTEGER,
+        score_max INTEGER,
+        first7_sum INTEGER NOT NULL,
+        first7_count INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS student_subject_stats (
+        student_id TEXT,
+        subject TEXT,
+        grade_count INTEGER NOT NULL,
+        score_sum INTEGER NOT NULL,
+        score_min INTEGER,
+        score_max INTEGER,
+        PRIMARY KEY (student_id, subject)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS teacher_grade_stats (
+        teacher_id TEXT PRIMARY KEY,
+        grade_count INTEGER NOT NULL,
+        score_sum INTEGER NOT NULL,
+        score_min INTEGER,
+        score_max INTEGER
+    )''',
+)
+
+def recompute_student(key):
+    return f'''DELETE FROM student_grade_stats WHERE student_id = {key};
+        INSERT INTO student_grade_stats
+        SELECT student_id, COUNT(*), SUM(score), MIN(score), MAX(score),
+               (SELECT SUM(score) FROM (SELECT score FROM grades WHERE student_id = {key} ORDER BY created_at, rowid LIMIT 7)),
+               (SELECT COUNT(*) FROM (SELECT 1 FROM grades WHERE student_id = {key} ORDER BY created_at, rowid LIMIT 7))
+        FROM grades WHERE student_id = {key} GROUP BY student_id;'''
+
+def recompute_subject(student_key, subject_key):
+    return f'''DELETE FROM student_subject_stats WHERE student_id = {student_key} AND subject = {subject_key};
+        INSERT INTO student_subject_stats
+        SELECT student_id, subject, COUNT(*), SUM(score), MIN(score), MAX(score)
+        FROM grades WHERE student_id = {student_key} AND subject = {subject_key} GROUP BY student_id, subject;'''
+
+def recompute_teacher(key):
+    return f'''DELETE FROM teacher_grade_stats WHERE teacher_id = {key};
+        INSERT INTO teacher_grade_stats
+        SELECT s.teacher_id, COUNT(*), SUM(g.score), MIN(g.score), MAX(g.score)
+        FROM students s JOIN grades g ON g.student_id = s.id
+        WHERE s.teacher_id = {key} GROUP BY s.teacher_id;'''
+
+# Inserts (the common case) adjust the aggregates in place; updates and deletes
+# recompute just the affected keys, since MIN/MAX cannot be decremented.
+GRADE_STATS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS grades_stats_insert AFTER INSERT ON grades
+    WHEN NEW.student_id IS NOT NULL BEGIN
+        INSERT INTO student_grade_stats VALUES (NEW.student_id, 1, NEW.score, NEW.score, NEW.score, NEW.score, 1)
+        ON CONFLICT (student_id) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max),
+            first7_sum = first7_sum + CASE WHEN first7_count < 7 THEN excluded.first7_sum ELSE 0 END,
+            first7_count = MIN(first7_count + 1, 7);
+        INSERT INTO student_subject_stats SELECT NEW.student_id, NEW.subject, 1, NEW.score, NEW.score, NEW.score
+        WHERE NEW.subject IS NOT NULL
+        ON CONFLICT (student_id, subject) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max);
+        INSERT INTO teacher_grade_stats SELECT teacher_id, 1, NEW.score, NEW.score, NEW.score
+        FROM students WHERE id = NEW.student_id AND teacher_id IS NOT NULL
+        ON CONFLICT (teacher_id) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS grades_stats_delete AFTER DELETE ON grades
+    WHEN OLD.student_id IS NOT NULL BEGIN
+        {recompute_student('OLD.student_id')}
+        {recompute_subject('OLD.student_id', 'OLD.subject')}
+        {recompute_teacher('(SELECT teacher_id FROM students WHERE id = OLD.student_id)')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS grades_stats_update AFTER UPDATE OF student_id, subject, score, created_at ON grades
+    BEGIN
+        {recompute_student('OLD.student_id')}
+        {recompute_student('NEW.student_id')}
+        {recompute_subject('OLD.student_id', 'OLD.subject')}
+        {recompute_subject('NEW.student_id', 'NEW.subject')}
+        {recompute_teacher('(SELECT teacher_id FROM students WHERE id = OLD.student_id)')}
+        {recompute_teacher('(SELECT teacher_id FROM students WHERE id = NEW.student_id)')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS students_stats_insert AFTER INSERT ON students
+    WHEN NEW.teacher_id IS NOT NULL BEGIN
+        {recompute_teacher('NEW.teacher_id')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS students_stats_teacher AFTER UPDATE OF teacher_id ON students
+    BEGIN
+        {recompute_teacher('OLD.teacher_id')}
+        {recompute_teacher('NEW.teacher_id')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS students_stats_delete AFTER DELETE ON students
+    BEGIN
+        {recompute_teacher('OLD.teacher_id')}
+    END''',
+)
+
+# Grades can arrive out of created_at order (back-dated rows, imports of older
+# grades), so the first-7 figures are read back from idx_grades_student_created
+# (at most 7 index entries) instead of assuming the new grade is the latest.
+# The other aggregates are still adjusted in place.
+FIRST7_FROM_GRADES = (
+    'DROP TRIGGER IF EXISTS grades_stats_insert',
+    '''CREATE TRIGGER grades_stats_insert AFTER INSERT ON grades
+    WHEN NEW.student_id IS NOT NULL BEGIN
+        INSERT INTO student_grade_stats VALUES (NEW.student_id, 1, NEW.score, NEW.score, NEW.score, NEW.score, 1)
+        ON CONFLICT (student_id) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max),
+            (first7_sum, first7_count) = (SELECT SUM(score), COUNT(*) FROM (
+                SELECT score FROM grades WHERE student_id = NEW.student_id ORDER BY created_at, rowid LIMIT 7));
+        INSERT INTO student_subject_stats SELECT NEW.student_id, NEW.subject, 1, NEW.score, NEW.score, NEW.score
+        WHERE NEW.subject IS NOT NULL
+        ON CONFLICT (student_id, subject) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max);
+        INSERT INTO teacher_grade_stats SELECT teacher_id, 1, NEW.score, NEW.score, NEW.score
+        FROM students WHERE id = NEW.student_id AND teacher_id IS NOT NULL
+        ON CONFLICT (teacher_id) DO UPDATE SET
+            grade_count = grade_count + 1,
+            score_sum = score_sum + excluded.score_sum,
+            score_min = MIN(score_min, excluded.score_min),
+            score_max = MAX(score_max, excluded.score_max);
+    END''',
+    # Fix rows that back-dated grades already left wrong.
+    model.GradeStats.rebuild,
+)
+
+UPLOAD_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS upload_blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER,
+        ref_count INTEGER NOT NULL,
+        created_at TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS uploads (
+        filename TEXT PRIMARY KEY,
+        sha256 TEXT,
+        size INTEGER,
+        content_type TEXT,
+        original_name TEXT,
+        created_at TIMESTAMP
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256)',
+)
+
+NOTIFICATION_COUNTERS = (
+    '''CREATE TABLE IF NOT EXISTS notification_counters (
+        user_id TEXT PRIMARY KEY,
+        unread INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS notifications_archive (
+        id TEXT PRIMARY KEY,
+        user_id TEXT,
+        content TEXT,
+        created_at TIMESTAMP,
+        is_read INTEGER,
+        archived_at TIMESTAMP
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS notifications_unread_insert AFTER INSERT ON notifications
+    WHEN NEW.is_read = 0 BEGIN
+        INSERT INTO notification_counters VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS notifications_unread_update AFTER UPDATE OF is_read, user_id ON notifications
+    BEGIN
+        UPDATE notification_counters SET unread = unread - 1 WHERE user_id = OLD.user_id AND OLD.is_read = 0;
+        INSERT INTO notification_counters SELECT NEW.user_id, 1 WHERE NEW.is_read = 0
+        ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS notifications_unread_delete AFTER DELETE ON notifications
+    WHEN OLD.is_read = 0 BEGIN
+        UPDATE notification_counters SET unread = unread - 1 WHERE user_id = OLD.user_id;
+    END''',
+    '''INSERT OR REPLACE INTO notification_counters
+    SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 AND user_id IS NOT NULL GROUP BY user_id''',
+)
+
+# Leaf tables: nothing else stores their ids, so existing rows can be re-keyed.
+TIME_ORDERED_TABLES = ('grades', 'messages', 'notifications', 'notifications_archive', 'private_messages',
+                       'remarks', 'targets', 'assignments')
+
+def rekey_time_ordered(c):
+    """Replace the uuid4 ids of leaf tables with UUIDv7s derived from created_at, then rebuild their indexes.
+
+    Users, students, chatrooms and groups keep their ids: they are referenced
+    from other tables, upload names, socket tokens and clients.
+    """
+    c.connection.create_function('time_ordered_id', 2, model.id_at, deterministic=True)
+    for table in TIME_ORDERED_TABLES:
+        c.execute(f"UPDATE {table} SET id = time_ordered_id(created_at, id) WHERE substr(id, 15, 1) != '7'")
+        c.execute(f'REINDEX {table}')
+
+# Tables whose list endpoints answer conditional GETs; every write to one bumps its counter.
+VERSIONED_TABLES = ('students', 'grades', 'chatrooms', 'groups')
+
+def resource_version_steps(tables):
+    """Statements that start version counters for `tables` and bump them from triggers."""
+    return (
+        # Random starting points, so a recreated database doesn't reuse ETags clients still hold.
+        *(f"INSERT OR IGNORE INTO resource_versions VALUES ('{table}', abs(random() % 1000000000))" for table in tables),
+        *(f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+    BEGIN
+        UPDATE resource_versions SET version = version + 1 WHERE resource = '{table}';
+    END''' for table in tables for event in ('INSERT', 'UPDATE', 'DELETE')),
+    )
+
+RESOURCE_VERSIONS = (
+    '''CREATE TABLE IF NOT EXISTS resource_versions (
+        resource TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )''',
+) + resource_version_steps(VERSIONED_TABLES)
+
+# Full-text indexed tables: (table, columns the scope is built from, scope expression).
+# Each FTS5 index reads its text back through a view of the table (external
+# content), so nothing is stored twice. The scope column holds a token per id
+# allowed to see the row: 's' + chatroom id or 'u' + user id, dashes removed.
+# search.py restricts matches with these tokens inside the index.
+SEARCH_SOURCES = (
+    ('messages', ('chatroom_id',), "'s' || replace({row}chatroom_id, '-', '')"),
+    ('private_messages', ('sender_id', 'receiver_id'),
+     "coalesce('u' || replace({row}sender_id, '-', ''), '') || ' ' || coalesce('u' || replace({row}receiver_id, '-', ''), '')"),
+    ('remarks', ('student_id', 'teacher_id'),
+     "coalesce('u' || replace({row}student_id, '-', ''), '') || ' ' || coalesce('u' || replace({row}teacher_id, '-', ''), '')"),
+)
+
+def search_index_steps(table, scope_columns, scope):
+    """Statements that create and fill `table`'s FTS5 index and keep it in step with triggers."""
+    fts = f'{table}_fts'
+    delete = f"INSERT INTO {fts}({fts}, rowid, content, scope) VALUES ('delete', OLD.rowid, OLD.content, {scope.format(row='OLD.')});"
+    insert = f"INSERT INTO {fts}(rowid, content, scope) VALUES (NEW.rowid, NEW.content, {scope.format(row='NEW.')});"
+    return (
+        f"CREATE VIEW IF NOT EXISTS {table}_search AS SELECT rowid AS rid, content, {scope.format(row='')} AS scope FROM {table}",
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(content, scope, content='{table}_search', content_rowid='rid',
+        tokenize='unicode61 remove_diacritics 2')''',
+        # Rank by the text alone; scope tokens only filter.
+        f"INSERT INTO {fts}({fts}, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+        {insert}
+    END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+        {delete}
+    END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF content, {', '.join(scope_columns)} ON {table} BEGIN
+        {delete}
+        {insert}
+    END''',
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    )
+
+SEARCH_INDEXES = tuple(step for source in SEARCH_SOURCES for step in search_index_steps(*source)) + (
+    # Finding the chatrooms a caller may search.
+    'CREATE INDEX IF NOT EXISTS idx_chatroom_members_user ON chatroom_members (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_chatrooms_teacher ON chatrooms (teacher_id)',
+)
+
+MIGRATIONS = [
+    (1, 'Create base tables', BASE_TABLES),
+    (2, 'Add lookup indexes for get_by_* queries', LOOKUP_INDEXES),
+    (3, 'Add trigger-maintained grade aggregates',
+     GRADE_STATS_TABLES + GRADE_STATS_TRIGGERS + (model.GradeStats.rebuild,)),
+    (4, 'Add content-addressed upload metadata', UPLOAD_TABLES),
+    (5, 'Add unread notification counters and archive', NOTIFICATION_COUNTERS),
+    (6, 'Re-key leaf tables with time-ordered ids', (rekey_time_ordered,)),
+    (7, 'Add trigger-maintained resource versions', RESOURCE_VERSIONS),
+    (8, 'Version targets for class analytics', resource_version_steps(('targets',))),
+    (9, 'Add full-text search indexes', SEARCH_INDEXES),
+    (10, 'Index assignments by creation time for streamed lists',
+     ('CREATE INDEX IF NOT EXISTS idx_assignments_created ON assignments (created_at, id)', 'ANALYZE assignments')),
+    (11, 'Compute first-7 grade sums from the grades themselves', FIRST7_FROM_GRADES),
+]
+
+# The get_by_* and foreign-key lookups from model.py, each with the indexes its
+# plan must SEARCH (see check_query_plans). Add new lookups here with their index.
+INDEXED_LOOKUPS = (
+    ('SELECT id FROM students WHERE teacher_id = ?', 'idx_students_teacher'),
+    ('SELECT id, subject, score, grade, created_at FROM grades WHERE student_id = ? ORDER BY created_at',
+     'idx_grades_student_created'),
+    ('SELECT id, user_id, content, type, created_at FROM messages WHERE chatroom_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+     'idx_messages_chatroom_created'),
+    ('SELECT id, subject, target FROM targets WHERE student_id = ?', 'idx_targets_student'),
+    ('SELECT id, content, created_at FROM remarks WHERE student_id = ?', 'idx_remarks_student_created'),
+    ('SELECT id, content, created_at, is_read FROM notifications WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+     'idx_notifications_user_created'),
+    ('SELECT id FROM private_messages WHERE sender_id = ? OR receiver_id = ?',
+     'idx_private_messages_sender_created', 'idx_private_messages_receiver_created'),
+    ('SELECT id FROM private_messages WHERE receiver_id = ? AND sender_id IS NOT ? ORDER BY created_at, id',
+     'idx_private_messages_receiver_created'),
+    ('SELECT id FROM assignments WHERE student_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+     'idx_assignments_student_created'),
+    ('SELECT id FROM assignments WHERE teacher_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+     'idx_assignments_teacher_created'),
+    ('SELECT id FROM assignments WHERE created_at >= ? AND (created_at > ? OR id > ?) ORDER BY created_at, id LIMIT ?',
+     'idx_assignments_created'),
+    ('SELECT chatroom_id FROM chatroom_members WHERE user_id = ?', 'idx_chatroom_members_user'),
+    ('SELECT id FROM chatrooms WHERE teacher_id = ?', 'idx_chatrooms_teacher'),
+)
+
+def check_query_plans():
+    """Return (query, plan) for each INDEXED_LOOKUPS query that scans a table or skips its index."""
+    failures = []
+    with model.db_cursor() as c:
+        for sql, *indexes in INDEXED_LOOKUPS:
+            c.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?'))
+            plan = [row[3] for row in c.fetchall()]
+            if any(step.startswith('SCAN') for step in plan) or \
+                    not all(any(f'INDEX {index} (' in step for step in plan) for index in indexes):
+                failures.append((sql, plan))
+    return failures
+
+def current_version(cursor):
+    """Return the highest applied migration version, or 0 for a fresh database."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP
+    )''')
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    return cursor.fetchone()[0] or 0
+
+def upgrade(target=None):
+    """Apply pending migrations in order and return the resulting version.
+
+    Runs under BEGIN IMMEDIATE so several workers starting at once apply each
+    migration exactly once; already-applied versions are skipped.
+    """
+    conn = model.get_db()
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        version = current_version(c)
+        for number, description, steps in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            for step in steps:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                      (number, description, datetime.now()))
+            version = number
+        c.execute('COMMIT')
+        return version
+    except Exception:
+        if conn.in_transaction:
+            c.execute('ROLLBACK')
+        raise
+    finally:
+        c.close()
+        conn.close()
@@ -1,35 +1,386 @@
+import base64
+import binascii
+import hashlib
+import json
+import secrets
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 from datetime import datetime
-import uuid
 import os
 
+try:
+    from gevent.local import local as _local
+except ImportError:
+    from threading import local as _local
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, 'grade_manager.db')
+DB_PATH = os.environ.get('DB_PATH', os.path.join(BASE_DIR, 'grade_manager.db'))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# Connections checked out at once; callers beyond it wait up to DB_POOL_TIMEOUT seconds.
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 32))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', 300))
+
+# Applied once when a connection is opened, not on every checkout.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 10000),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -8000),
+    ('mmap_size', 67108864),
+)
 
 def connect_db():
        return sqlite3.connect(DB_PATH)
 # Database connection management
 def get_db():
-    """Connect to the SQLite database."""
-    conn = sqlite3.connect('grade_manager.db', timeout=10)
+    """Open a new connection to the SQLite database with the standard PRAGMAs."""
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for name, value in SQLITE_PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    conn.create_function('student_grading', 1, student_grading, deterministic=True)
     return conn
 
+class PoolExhausted(Exception):
+    """Raised when no connection frees up within the pool's timeout."""
+
+class ConnectionPool:
+    """Hand out one reusable connection per thread (or greenlet) at a time.
+
+    Nested checkouts in the same thread share the outer connection, so only the
+    outermost db_cursor() commits or rolls back. At most `max_connections` are
+    checked out at once; further callers wait up to `timeout` seconds for one,
+    then get PoolExhausted. Up to `size` idle connections are kept; connections
+    idle for longer than `recycle` seconds are pinged before reuse and replaced
+    if the ping fails.
+    """
+    def __init__(self, connect=get_db, size=DB_POOL_SIZE, recycle=DB_POOL_RECYCLE,
+                 max_connections=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        self.connect = connect
+        self.size = size
+        self.recycle = recycle
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = _local()
+        self._in_use = 0
+        self._counters = {'created': 0, 'reused': 0, 'checkouts': 0, 'discarded': 0, 'health_failures': 0,
+                          'waits': 0, 'timeouts': 0, 'max_in_use': 0}
+
+    def depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def defer(self, callback):
+        """Run callback when this thread's outermost checkout ends, after its commit or rollback.
+
+        Runs it at once when nothing is checked out.
+        """
+        if self.depth():
+            self._local.deferred.append(callback)
+        else:
+            callback()
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.recycle or self._ping(conn):
+                with self._lock:
+                    self._counters['reused'] += 1
+                return conn
+            with self._lock:
+                self._counters['health_failures'] += 1
+            self._close(conn)
+        conn = self.connect()
+        with self._lock:
+            self._counters['created'] += 1
+        return conn
+
+    @staticmethod
+    def _ping(conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._counters['discarded'] += 1
+
+    def acquire(self):
+        local = self._local
+        if self.depth():
+            local.depth += 1
+            return local.conn
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._counters['timeouts'] += 1
+                raise PoolExhausted(f'No database connection free after {self.timeout:g}s')
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._counters['checkouts'] += 1
+            self._in_use += 1
+            self._counters['max_in_use'] = max(self._counters['max_in_use'], self._in_use)
+        local.conn = conn
+        local.depth = 1
+        local.deferred = []
+        return conn
+
+    def release(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth:
+            return
+        conn = local.conn
+        local.conn = None
+        deferred, local.deferred = local.deferred, []
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._in_use -= 1
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.monotonic()))
+                    conn = None
+            if conn is not None:
+                self._close(conn)
+        finally:
+            self._slots.release()
+        for callback in deferred:
+            callback()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, size=self.size, max_connections=self.max_connections,
+                        idle=len(self._idle), in_use=self._in_use)
+
+pool = ConnectionPool()
+
+# Native threads gevent may use to run SQLite calls off the event loop.
+DB_THREADS = int(os.environ.get('DB_THREADS', 8))
+
+def _gevent_threadpool():
+    """Return the current hub's native thread pool when running under monkey-patched gevent."""
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+    threadpool = get_hub().threadpool
+    if threadpool.maxsize < DB_THREADS:
+        threadpool.maxsize = DB_THREADS
+    return threadpool
+
+class CooperativeCursor:
+    """Cursor proxy that runs each blocking SQLite call in gevent's native thread pool.
+
+    sqlite3 releases the GIL while it works, so other greenlets (HTTP requests,
+    websockets) keep running instead of stalling behind the query.
+    """
+    __slots__ = ('_cursor', '_threadpool')
+
+    def __init__(self, cursor, threadpool):
+        self._cursor = cursor
+        self._threadpool = threadpool
+
+    def execute(self, sql, params=()):
+        self._threadpool.apply(self._cursor.execute, (sql, params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._threadpool.apply(self._cursor.executemany, (sql, list(seq_of_params)))
+        return self
+
+    def fetchone(self):
+        return self._threadpool.apply(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._threadpool.apply(self._cursor.fetchall)
+
+    def fetchmany(self, size=None):
+        return self._threadpool.apply(self._cursor.fetchmany, (size or self._cursor.arraysize,))
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+# Called as query_observer(conn, sql, params, seconds) once each statement is
+# done (its fetches included); app.py points it at metrics.observe_query.
+query_observer = None
+
+class TimedCursor:
+    """Cursor proxy that times each statement from execute() through its last fetch."""
+    __slots__ = ('_cursor', '_conn', '_sql', '_params', '_seconds')
+
+    def __init__(self, cursor, conn):
+        self._cursor = cursor
+        self._conn = conn
+        self._sql = None
+
+    def _finish(self):
+        if self._sql is not None and query_observer is not None:
+            query_observer(self._conn, self._sql, self._params, self._seconds)
+        self._sql = None
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._seconds += time.perf_counter() - started
+
+    def execute(self, sql, params=()):
+        self._finish()
+        self._sql, self._params, self._seconds = sql, params, 0.0
+        self._timed(self._cursor.execute, sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        seq_of_params = list(seq_of_params)
+        self._sql, self._params, self._seconds = sql, seq_of_params, 0.0
+        self._timed(self._cursor.executemany, sql, seq_of_params)
+        return self
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def fetchmany(self, size=None):
+        return self._timed(self._cursor.fetchmany, *(() if size is None else (size,)))
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
 @contextmanager
 def db_cursor():
     """Provide a cursor with transaction management."""
-    conn = get_db()
-    cursor = conn.cursor()
+    conn = pool.acquire()
+    outermost = pool.depth() == 1
+    threadpool = _gevent_threadpool()
+    cursor = conn.cursor() if threadpool is None else CooperativeCursor(conn.cursor(), threadpool)
+    if query_observer is not None:
+        cursor = TimedCursor(cursor, conn)
     try:
         yield cursor
-        conn.commit()
+        if outermost:
+            writing = conn.in_transaction
+            started = time.perf_counter()
+            conn.commit() if threadpool is None else threadpool.apply(conn.commit)
+            if writing and query_observer is not None:
+                query_observer(conn, 'COMMIT', (), time.perf_counter() - started)
     except Exception:
-        conn.rollback()
+        if outermost:
+            conn.rollback()
         raise
     finally:
         cursor.close()
-        conn.close()
+        pool.release()
+
+_id_lock = threading.Lock()
+_id_clock = [0, 0]  # last millisecond handed out, sequence number within it
+
+def _uuid_string(value):
+    digits = f'{value:032x}'
+    return f'{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}'
+
+def new_id(at=None):
+    """Return a time-ordered UUIDv7 string for a new primary key.
+
+    48 bits of Unix milliseconds come first, then a 12-bit sequence that keeps
+    ids from one process increasing within a millisecond, then 62 random
+    bits. Later ids sort later, as text too, so inserts append to the end of
+    the primary-key index instead of landing on random pages. Pass `at` (a
+    datetime) for rows that are backdated.
+    """
+    if at is not None:
+        ms = int(at.timestamp() * 1000)
+        return _uuid_string(ms << 80 | 0x7 << 76 | secrets.randbits(12) << 64 | 0b10 << 62 | secrets.randbits(62))
+    with _id_lock:
+        ms = time.time_ns() // 1_000_000
+        last, seq = _id_clock
+        if ms > last:
+            seq = secrets.randbits(10)  # random start, with room for 3000+ more ids this millisecond
+        else:
+            ms, seq = last, seq + 1
+            if seq > 0xfff:
+                ms, seq = last + 1, 0
+        _id_clock[0], _id_clock[1] = ms, seq
+    return _uuid_string(ms << 80 | 0x7 << 76 | seq << 64 | 0b10 << 62 | secrets.randbits(62))
+
+def id_at(created_at, salt):
+    """Return a UUIDv7 string for a row created at created_at, with the other bits derived from salt.
+
+    Used to re-key existing rows: the result is deterministic, and ordering by
+    it matches ordering by created_at. Returns salt unchanged when
+    created_at can't be parsed.
+    """
+    try:
+        ms = int(datetime.fromisoformat(str(created_at)).timestamp() * 1000)
+    except ValueError:
+        return salt
+    bits = int.from_bytes(hashlib.sha1(str(salt).encode()).digest()[:10], 'big')
+    return _uuid_string(ms << 80 | 0x7 << 76 | (bits >> 68) << 64 | 0b10 << 62 | bits & (1 << 62) - 1)
 
 def student_grading(mark):
     """Convert a numeric score to a letter grade."""
@@ -50,12 +401,455 @@ def student_grading(mark):
     except:
         return "invalid"
 
+CACHE_URL = os.environ.get('CACHE_URL')
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 4096))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 30))
+
+class LRUCache:
+    """In-process LRU cache whose entries expire `ttl` seconds after being set."""
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        # Bumped by every delete; see set().
+        self._generation = 0
+        # Set by pubsub.sync_cache when other worker processes hold their own copy.
+        self.publish = None
+
+    def get(self, key):
+        """Return (found, value)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return False, None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return True, value
+
+    def generation(self):
+        """Return a token to pass to set() for a value that is about to be loaded."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        """Store value, unless `generation` is given and a delete has happened since it was taken."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def delete(self, key, broadcast=True):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._counters['invalidations'] += 1
+        if broadcast and self.publish:
+            self.publish('delete', key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, size=len(self._entries), maxsize=self.maxsize)
+
+class LocalRedis:
+    """Single-process stand-in for the subset of the redis-py client SharedCache uses.
+
+    Selected with CACHE_URL=local://, which runs the shared-cache code path without a Redis server.
+    """
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (None, 0))
+            if expires < time.monotonic():
+                self._data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._data.get(key, (None, 0))[1] >= time.monotonic():
+                return None
+            self._data[key] = (value, time.monotonic() + (ex if ex is not None else float('inf')))
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+# A deleted key holds an empty tombstone for this many seconds, so a reader that
+# loaded the row before the write cannot cache it again (see SharedCache.set).
+CACHE_INVALIDATION_GRACE = 5
+
+class SharedCache:
+    """Cache shared between worker processes through a Redis-compatible client.
+
+    Values are stored as JSON, so only plain dicts/lists/scalars are cached.
+    """
+    def __init__(self, client, ttl=CACHE_TTL, prefix='gm:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        # Set by pubsub.sync_cache when the client is a per-process LocalRedis.
+        self.publish = None
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if not raw:
+            self._count('misses')
+            return False, None
+        self._count('hits')
+        return True, json.loads(raw)
+
+    def generation(self):
+        return None
+
+    def set(self, key, value, generation=None):
+        """Store value unless the key is set, or holds a tombstone, which covers every process."""
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)), nx=True)
+
+    def delete(self, key, broadcast=True):
+        self.client.set(self.prefix + key, '', ex=CACHE_INVALIDATION_GRACE)
+        self._count('invalidations')
+        if broadcast and self.publish:
+            self.publish('delete', key)
+
+    def clear(self):
+        self.client.flushdb()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+def make_cache():
+    """Use a shared Redis cache when CACHE_URL is set (and redis is installed), else an in-process LRU.
+
+    CACHE_URL=local:// keeps the shared cache's JSON store in this process instead.
+    """
+    if CACHE_URL and CACHE_URL.startswith('local://'):
+        return SharedCache(LocalRedis())
+    if CACHE_URL:
+        try:
+            import redis
+        except ImportError:
+            print('CACHE_URL is set but redis is not installed; using the in-process cache')
+        else:
+            return SharedCache(redis.Redis.from_url(CACHE_URL))
+    return LRUCache()
+
+cache = make_cache()
+
+def cached_row(key, loader):
+    """Return loader()'s row as a dict, serving it from the cache when possible.
+
+    Missing rows are cached as None too, so creates must invalidate their key.
+    The value is not cached if the key was invalidated while it was loading.
+    """
+    found, value = cache.get(key)
+    if found:
+        return value
+    generation = cache.generation()
+    row = loader()
+    value = dict(row) if row is not None else None
+    cache.set(key, value, generation)
+    return value
+
+def invalidate(key):
+    """Drop `key` from the row cache once the current transaction has committed, or at once outside one."""
+    pool.defer(lambda: cache.delete(key))
+
+CHAT_CACHE_MESSAGES = int(os.environ.get('CHAT_CACHE_MESSAGES', 50))
+CHAT_CACHE_ROOMS = int(os.environ.get('CHAT_CACHE_ROOMS', 1000))
+CHAT_CACHE_TOTAL = int(os.environ.get('CHAT_CACHE_TOTAL', 20000))
+
+class CachedMessage:
+    """Compact chat message record that can be indexed like a sqlite3.Row."""
+    __slots__ = ('id', 'user_id', 'content', 'type', 'created_at')
+
+    def __init__(self, id, user_id, content, type, created_at):
+        self.id = id
+        self.user_id = user_id
+        self.content = content
+        self.type = type
+        self.created_at = created_at
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class _CachedRoom:
+    __slots__ = ('messages', 'complete', 'members')
+
+    def __init__(self):
+        self.messages = None
+        self.complete = False
+        self.members = None
+
+class ChatroomCache:
+    """Recent messages and member sets of recently used chatrooms.
+
+    Rooms are loaded lazily from SQLite and then kept current by Messages and
+    ChatroomMembers writes. A room holds at most `per_room` messages and is
+    `complete` while its whole history fits. At most `max_rooms` rooms and
+    `max_total` messages are kept; idle rooms are evicted least recently used
+    first. A write that lands while a room is being loaded discards that load,
+    so a stale snapshot is never cached. Writes made by other workers arrive
+    through `publish` (see pubsub.sync_cache).
+    """
+    def __init__(self, per_room=CHAT_CACHE_MESSAGES, max_rooms=CHAT_CACHE_ROOMS, max_total=CHAT_CACHE_TOTAL):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.max_total = max_total
+        self._rooms = OrderedDict()
+        self._loading = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.publish = None
+
+    def _room(self, chatroom_id):
+        room = self._rooms.get(chatroom_id)
+        if room is None:
+            room = self._rooms[chatroom_id] = _CachedRoom()
+        self._rooms.move_to_end(chatroom_id)
+        return room
+
+    def _evict(self):
+        while len(self._rooms) > self.max_rooms or self._total > self.max_total:
+            _, room = self._rooms.popitem(last=False)
+            self._total -= len(room.messages or ())
+            self._counters['evictions'] += 1
+
+    def recent(self, chatroom_id, limit=None):
+        """Return the newest `limit` messages oldest first (all when None), or None if the cache can't say."""
+        with self._lock:
+            room = self._rooms.get(chatroom_id)
+            if room is not None and room.messages is not None:
+                self._rooms.move_to_end(chatroom_id)
+                self._counters['hits'] += 1
+                return self._answer(room.messages, room.complete, limit)
+            self._counters['misses'] += 1
+            # Concurrent loads share one flag, so a later load can't clear a write seen by an earlier one.
+            self._loading.setdefault(('messages', chatroom_id), False)
+        with db_cursor() as c:
+            c.execute('''SELECT id, user_id, content, type, created_at FROM messages WHERE chatroom_id = ?
+                         ORDER BY created_at DESC, id DESC LIMIT ?''', (chatroom_id, self.per_room + 1))
+            rows = c.fetchall()
+        complete = len(rows) <= self.per_room
+        messages = deque((CachedMessage(*row) for row in reversed(rows[:self.per_room])), maxlen=self.per_room)
+        with self._lock:
+            if not self._loading.pop(('messages', chatroom_id), True):
+                room = self._room(chatroom_id)
+                self._total += len(messages) - len(room.messages or ())
+                room.messages = messages
+                room.complete = complete
+                self._evict()
+        return self._answer(messages, complete, limit)
+
+    def _answer(self, messages, complete, limit):
+        if limit is None:
+            return list(messages) if complete else None
+        if limit > len(messages) and not complete:
+            return None
+        return list(messages)[-limit:]
+
+    def append(self, chatroom_id, message_id, user_id, content, msg_type, created_at, broadcast=True):
+        if broadcast and self.publish:
+            self.publish('append', chatroom_id, message_id, user_id, content, msg_type, str(created_at))
+        with self._lock:
+            if ('messages', chatroom_id) in self._loading:
+                self._loading[('messages', chatroom_id)] = True
+            room = self._rooms.get(chatroom_id)
+            if room is None or room.messages is None:
+                return
+            message = CachedMessage(message_id, user_id, content, msg_type, str(created_at))
+            messages = room.messages
+            # Another worker's message can arrive after newer local ones; keep created_at order.
+            pos = len(messages)
+            while pos and (messages[pos - 1].created_at, messages[pos - 1].id) > (message.created_at, message.id):
+                pos -= 1
+            if len(messages) == self.per_room:
+                room.complete = False
+                if pos == 0:
+                    return
+                messages.popleft()
+                pos -= 1
+            else:
+                self._total += 1
+            messages.insert(pos, message)
+            self._rooms.move_to_end(chatroom_id)
+            self._evict()
+
+    def members(self, chatroom_id):
+        """Return the member id set of a chatroom, loading it on first use."""
+        with self._lock:
+            room = self._rooms.get(chatroom_id)
+            if room is not None and room.members is not None:
+                self._rooms.move_to_end(chatroom_id)
+                self._counters['hits'] += 1
+                return set(room.members)
+            self._counters['misses'] += 1
+            self._loading.setdefault(('members', chatroom_id), False)
+        with db_cursor() as c:
+            c.execute('SELECT user_id FROM chatroom_members WHERE chatroom_id = ?', (chatroom_id,))
+            members = {row['user_id'] for row in c.fetchall()}
+        with self._lock:
+            if not self._loading.pop(('members', chatroom_id), True):
+                self._room(chatroom_id).members = members
+                self._evict()
+        return set(members)
+
+    def member_changed(self, chatroom_id, user_id, joined, broadcast=True):
+        if broadcast and self.publish:
+            self.publish('member_changed', chatroom_id, user_id, joined)
+        with self._lock:
+            if ('members', chatroom_id) in self._loading:
+                self._loading[('members', chatroom_id)] = True
+            room = self._rooms.get(chatroom_id)
+            if room is None or room.members is None:
+                return
+            if joined:
+                room.members.add(user_id)
+            else:
+                room.members.discard(user_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, rooms=len(self._rooms), messages=self._total,
+                        max_rooms=self.max_rooms, max_total=self.max_total)
+
+chat_cache = ChatroomCache()
+
+def encode_cursor(row):
+    """Encode a row's (created_at, id) position as an opaque page cursor."""
+    raw = f"{row['created_at']}|{row['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    """Decode a page cursor back into (created_at, id); raise ValueError if malformed."""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    return created_at, row_id
+
+def keyset_query(c, select, where, params, limit=None, before=None, after=None, descending=False):
+    """Run `select` ordered by (created_at, id) with optional keyset pagination.
+
+    `before`/`after` are cursors from encode_cursor(). Without `after` the page
+    holds the newest `limit` matching rows; with it, the oldest rows past the
+    cursor. Rows come back ascending, or descending when `descending` is set.
+    """
+    clauses = [where]
+    params = list(params)
+    if before:
+        created_at, row_id = decode_cursor(before)
+        clauses.append('created_at <= ? AND (created_at < ? OR id < ?)')
+        params += [created_at, created_at, row_id]
+    if after:
+        created_at, row_id = decode_cursor(after)
+        clauses.append('created_at >= ? AND (created_at > ? OR id > ?)')
+        params += [created_at, created_at, row_id]
+    newest_first = descending if not limit else not after
+    order = 'DESC' if newest_first else 'ASC'
+    sql = f'{select} WHERE {" AND ".join(clauses)} ORDER BY created_at {order}, id {order}'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    c.execute(sql, params)
+    rows = c.fetchall()
+    if newest_first != descending:
+        rows.reverse()
+    return rows
+
+# Rows fetched per round trip when a query is streamed instead of fetched whole.
+STREAM_BATCH = int(os.environ.get('STREAM_BATCH', 500))
+
+def stream_query(sql, params=(), batch=STREAM_BATCH):
+    """Yield the rows of a SELECT as lists of up to `batch` rows, fetching each batch on demand.
+
+    The connection and its read transaction stay checked out until the
+    generator is exhausted or closed, so only use this for readers that consume
+    it at once and want one snapshot; responses use stream_keyset.
+    """
+    with db_cursor() as c:
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(batch)
+            if not rows:
+                return
+            yield rows
+
+def stream_keyset(select, where, params=(), descending=False, key=('created_at', 'id'), batch=STREAM_BATCH):
+    """Yield the rows of `select` ordered by `key`, as lists of up to `batch` rows.
+
+    Every batch is a short query of its own that resumes after the last row of
+    the previous one, so a slow consumer, such as a client reading a streamed
+    response, holds no pooled connection or read transaction in between.
+    `key` is ('created_at', 'id') or ('id',), and must be among the selected columns.
+    """
+    order, op = ('DESC', '<') if descending else ('ASC', '>')
+    last = None
+    while True:
+        clauses, args = [where], list(params)
+        if last is not None and key == ('id',):
+            clauses.append(f'id {op} ?')
+            args.append(last['id'])
+        elif last is not None:
+            clauses.append(f'created_at {op}= ? AND (created_at {op} ? OR id {op} ?)')
+            args += [last['created_at'], last['created_at'], last['id']]
+        with db_cursor() as c:
+            c.execute(f'{select} WHERE {" AND ".join(clauses)} ORDER BY {", ".join(f"{k} {order}" for k in key)} LIMIT ?',
+                      args + [batch])
+            rows = c.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < batch:
+            return
+        last = rows[-1]
+
+def next_cursor(rows, limit, after=None, descending=False):
+    """Return the cursor that continues a keyset page, or None at the end."""
+    if not limit or len(rows) < limit:
+        return None
+    # Continue backwards from the oldest row, or forwards from the newest when paging with `after`.
+    oldest, newest = (rows[-1], rows[0]) if descending else (rows[0], rows[-1])
+    return encode_cursor(newest if after else oldest)
+
 # Model Classes
 class Users:
     """Manage users table operations."""
     @staticmethod
     def create(name, email, password, role, bio='', profile_photo=None):
-        user_id = str(uuid.uuid4())
+        user_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO users (id, name, email, password, role, bio, profile_photo) VALUES (?, ?, ?, ?, ?, ?, ?)',
                       (user_id, name, email, password, role, bio, profile_photo))
@@ -63,6 +857,10 @@ class Users:
 
     @staticmethod
     def get_by_id(user_id):
+        return cached_row(f'users:{user_id}', lambda: Users._load(user_id))
+
+    @staticmethod
+    def _load(user_id):
         with db_cursor() as c:
             c.execute('SELECT id, name, email, role, bio, profile_photo FROM users WHERE id = ?', (user_id,))
             return c.fetchone()
@@ -96,11 +894,29 @@ class Users:
             if fields:
                 values.append(user_id)
                 c.execute(f'UPDATE users SET {", ".join(fields)} WHERE id = ?', values)
+        invalidate(f'users:{user_id}')
+
+    @staticmethod
+    def set_profile_photo(user_id, filename):
+        """Point the user's and their student row's profile_photo at filename; return the previous one."""
+        with db_cursor() as c:
+            c.execute('SELECT profile_photo FROM users WHERE id = ?', (user_id,))
+            row = c.fetchone()
+            c.execute('UPDATE users SET profile_photo = ? WHERE id = ?', (filename, user_id))
+            c.execute('UPDATE students SET profile_photo = ? WHERE id = ?', (filename, user_id))
+        invalidate(f'users:{user_id}')
+        invalidate(f'students:{user_id}')
+        return row['profile_photo'] if row else None
 
     @staticmethod
     def delete(user_id):
+        """Delete a user and return their profile_photo, so the caller can release it."""
         with db_cursor() as c:
+            c.execute('SELECT profile_photo FROM users WHERE id = ?', (user_id,))
+            row = c.fetchone()
             c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        invalidate(f'users:{user_id}')
+        return row['profile_photo'] if row else None
 
 class Students:
     """Manage students table operations."""
@@ -109,9 +925,14 @@ class Students:
         with db_cursor() as c:
             c.execute('INSERT INTO students (id, name, email, teacher_id, profile_photo) VALUES (?, ?, ?, ?, ?)',
                       (student_id, name, email, teacher_id, profile_photo))
+        invalidate(f'students:{student_id}')
 
     @staticmethod
     def get_by_id(student_id):
+        return cached_row(f'students:{student_id}', lambda: Students._load(student_id))
+
+    @staticmethod
+    def _load(student_id):
         with db_cursor() as c:
             c.execute('SELECT id, name, email, teacher_id, profile_photo FROM students WHERE id = ?', (student_id,))
             return c.fetchone()
@@ -122,6 +943,25 @@ class Students:
             c.execute('SELECT id, name, email, teacher_id, profile_photo FROM students')
             return c.fetchall()
 
+    @staticmethod
+    def get_all_with_general_grade():
+        """Return every student with a general grade, best grades first.
+
+        The general grade is student_grading() of the average of a student's
+        first 7 grades by created_at, or 'E' when they have no grades. The
+        first-7 sums come from student_grade_stats.
+        """
+        with db_cursor() as c:
+            c.execute('''
+                SELECT s.id, s.name, s.email, s.teacher_id, s.profile_photo,
+                       CASE WHEN st.first7_count IS NULL OR st.first7_count = 0 THEN 'E'
+                            ELSE student_grading(CAST(st.first7_sum AS REAL) / st.first7_count) END AS general_grade
+                FROM students s LEFT JOIN student_grade_stats st ON st.student_id = s.id
+                ORDER BY CASE general_grade WHEN 'A' THEN 5 WHEN 'B' THEN 4 WHEN 'C' THEN 3 WHEN 'D' THEN 2 ELSE 1 END DESC,
+                         s.rowid
+            ''')
+            return c.fetchall()
+
     @staticmethod
     def update(student_id, name=None, email=None, teacher_id=None, profile_photo=None):
         with db_cursor() as c:
@@ -142,44 +982,155 @@ class Students:
             if fields:
                 values.append(student_id)
                 c.execute(f'UPDATE students SET {", ".join(fields)} WHERE id = ?', values)
+        invalidate(f'students:{student_id}')
 
     @staticmethod
     def delete(student_id):
+        """Delete a student and return their profile_photo, so the caller can release it."""
         with db_cursor() as c:
+            c.execute('SELECT profile_photo FROM students WHERE id = ?', (student_id,))
+            row = c.fetchone()
             c.execute('DELETE FROM students WHERE id = ?', (student_id,))
+        invalidate(f'students:{student_id}')
+        return row['profile_photo'] if row else None
 
 class Grades:
     """Manage grades table operations."""
     @staticmethod
     def create(student_id, subject, score, grade):
-        grade_id = str(uuid.uuid4())
+        if score is None:
+            raise ValueError('Grade score is required')
+        grade_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO grades (id, student_id, subject, score, grade, created_at) VALUES (?, ?, ?, ?, ?, ?)',
                       (grade_id, student_id, subject, score, grade, datetime.now()))
         return grade_id
 
+    @staticmethod
+    def create_many(rows):
+        """Insert (student_id, subject, score, grade) rows in one transaction and return their ids."""
+        if any(row[2] is None for row in rows):
+            raise ValueError('Grade score is required')
+        now = datetime.now()
+        records = [(new_id(), student_id, subject, score, grade, now) for student_id, subject, score, grade in rows]
+        with db_cursor() as c:
+            c.executemany('INSERT INTO grades (id, student_id, subject, score, grade, created_at) VALUES (?, ?, ?, ?, ?, ?)', records)
+        return [r[0] for r in records]
+
     @staticmethod
     def get_by_student(student_id):
         with db_cursor() as c:
             c.execute('SELECT id, subject, score, grade, created_at FROM grades WHERE student_id = ? ORDER BY created_at', (student_id,))
             return c.fetchall()
 
+    @staticmethod
+    def count_by_teacher(teacher_id):
+        """Return {student_id: number of grades} for every student in a teacher's class."""
+        with db_cursor() as c:
+            c.execute('''SELECT s.id, COUNT(g.id) AS grade_count FROM students s
+                         LEFT JOIN grades g ON g.student_id = s.id
+                         WHERE s.teacher_id = ? GROUP BY s.id''', (teacher_id,))
+            return {row['id']: row['grade_count'] for row in c.fetchall()}
+
     @staticmethod
     def get_all():
         with db_cursor() as c:
             c.execute('SELECT id, student_id, subject, score, grade FROM grades')
             return c.fetchall()
 
+    @staticmethod
+    def stream_all():
+        return stream_keyset('SELECT id, student_id, subject, score, grade FROM grades', '1 = 1', key=('id',))
+
+# Fresh aggregates over grades, in the column order of each *_stats table. Used
+# to rebuild the tables and to check the trigger-maintained copies against.
+GRADE_STATS_QUERIES = {
+    'student_grade_stats': '''SELECT student_id, COUNT(*), SUM(score), MIN(score), MAX(score),
+                                     SUM(CASE WHEN n <= 7 THEN score ELSE 0 END), SUM(n <= 7)
+                              FROM (SELECT student_id, score,
+                                           ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY created_at, rowid) AS n
+                                    FROM grades WHERE student_id IS NOT NULL)
+                              GROUP BY student_id''',
+    'student_subject_stats': '''SELECT student_id, subject, COUNT(*), SUM(score), MIN(score), MAX(score)
+                                FROM grades WHERE student_id IS NOT NULL AND subject IS NOT NULL
+                                GROUP BY student_id, subject''',
+    'teacher_grade_stats': '''SELECT s.teacher_id, COUNT(*), SUM(g.score), MIN(g.score), MAX(g.score)
+                              FROM grades g JOIN students s ON s.id = g.student_id
+                              WHERE s.teacher_id IS NOT NULL GROUP BY s.teacher_id''',
+}
+
+class GradeStats:
+    """Read the grade aggregates that triggers keep up to date on every grades write."""
+    @staticmethod
+    def for_student(student_id):
+        with db_cursor() as c:
+            c.execute('''SELECT grade_count, score_sum, score_min, score_max, first7_sum, first7_count
+                         FROM student_grade_stats WHERE student_id = ?''', (student_id,))
+            return c.fetchone()
+
+    @staticmethod
+    def for_student_subjects(student_id):
+        with db_cursor() as c:
+            c.execute('''SELECT subject, grade_count, score_sum, score_min, score_max
+                         FROM student_subject_stats WHERE student_id = ? ORDER BY subject''', (student_id,))
+            return c.fetchall()
+
+    @staticmethod
+    def for_teacher(teacher_id):
+        with db_cursor() as c:
+            c.execute('''SELECT grade_count, score_sum, score_min, score_max
+                         FROM teacher_grade_stats WHERE teacher_id = ?''', (teacher_id,))
+            return c.fetchone()
+
+    @staticmethod
+    def rebuild(c=None):
+        """Recompute every aggregate table from grades."""
+        if c is None:
+            with db_cursor() as c:
+                return GradeStats.rebuild(c)
+        for table, query in GRADE_STATS_QUERIES.items():
+            c.execute(f'DELETE FROM {table}')
+            c.execute(f'INSERT INTO {table} {query}')
+
+    @staticmethod
+    def check():
+        """Return {table: number of rows that differ from a fresh aggregate}."""
+        mismatches = {}
+        with db_cursor() as c:
+            for table, query in GRADE_STATS_QUERIES.items():
+                c.execute(f'''SELECT COUNT(*) FROM (
+                                 SELECT * FROM (SELECT * FROM {table} EXCEPT {query})
+                                 UNION ALL
+                                 SELECT * FROM ({query} EXCEPT SELECT * FROM {table}))''')
+                mismatches[table] = c.fetchone()[0]
+        return mismatches
+
+class ResourceVersions:
+    """Read the change counters that triggers bump on every write to a versioned table."""
+    @staticmethod
+    def get(*resources):
+        """Return the current versions of `resources` as a tuple, 0 for unknown ones."""
+        with db_cursor() as c:
+            c.execute('SELECT resource, version FROM resource_versions')
+            versions = dict(c.fetchall())
+        return tuple(versions.get(r, 0) for r in resources)
+
 class Chatrooms:
     """Manage chatrooms table operations."""
     @staticmethod
     def create(name, teacher_id):
-        chatroom_id = str(uuid.uuid4())
+        chatroom_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO chatrooms (id, name, teacher_id, created_at) VALUES (?, ?, ?, ?)',
                       (chatroom_id, name, teacher_id, datetime.now()))
         return chatroom_id
 
+    @staticmethod
+    def get_by_id(chatroom_id):
+        with db_cursor() as c:
+            c.execute('SELECT id, name, teacher_id FROM chatrooms WHERE id = ?', (chatroom_id,))
+            return c.fetchone()
+
     @staticmethod
     def get_all():
         with db_cursor() as c:
@@ -192,39 +1143,49 @@ class ChatroomMembers:
     def add(chatroom_id, user_id):
         with db_cursor() as c:
             c.execute('INSERT OR IGNORE INTO chatroom_members (chatroom_id, user_id) VALUES (?, ?)', (chatroom_id, user_id))
+        chat_cache.member_changed(chatroom_id, user_id, joined=True)
 
     @staticmethod
     def remove(chatroom_id, user_id):
         with db_cursor() as c:
             c.execute('DELETE FROM chatroom_members WHERE chatroom_id = ? AND user_id = ?', (chatroom_id, user_id))
+        chat_cache.member_changed(chatroom_id, user_id, joined=False)
 
     @staticmethod
     def get_members(chatroom_id):
-        with db_cursor() as c:
-            c.execute('SELECT user_id FROM chatroom_members WHERE chatroom_id = ?', (chatroom_id,))
-            return [row['user_id'] for row in c.fetchall()]
+        return sorted(chat_cache.members(chatroom_id))
 
 class Messages:
     """Manage messages table operations."""
     @staticmethod
     def create(chatroom_id, user_id, content, msg_type):
-        message_id = str(uuid.uuid4())
-        with db_cursor() as c:
-            c.execute('INSERT INTO messages (id, chatroom_id, user_id, content, type, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                      (message_id, chatroom_id, user_id, content, msg_type, datetime.now()))
+        message_id = new_id()
+        Messages.create_many([(message_id, chatroom_id, user_id, content, msg_type, datetime.now())])
         return message_id
 
     @staticmethod
-    def get_by_chatroom(chatroom_id):
+    def create_many(records):
+        """Insert (id, chatroom_id, user_id, content, type, created_at) records in one transaction."""
         with db_cursor() as c:
-            c.execute('SELECT id, user_id, content, type, created_at FROM messages WHERE chatroom_id = ?', (chatroom_id,))
-            return c.fetchall()
+            c.executemany('INSERT INTO messages (id, chatroom_id, user_id, content, type, created_at) VALUES (?, ?, ?, ?, ?, ?)', records)
+        for message_id, chatroom_id, user_id, content, msg_type, created_at in records:
+            chat_cache.append(chatroom_id, message_id, user_id, content, msg_type, created_at)
+
+    @staticmethod
+    def get_by_chatroom(chatroom_id, limit=None, before=None, after=None):
+        if not before and not after:
+            messages = chat_cache.recent(chatroom_id, limit)
+            if messages is not None:
+                return messages
+        with db_cursor() as c:
+            return keyset_query(c, 'SELECT id, user_id, content, type, created_at FROM messages',
+                                'chatroom_id = ?', (chatroom_id,), limit, before, after)
 
 class Groups:
     """Manage groups table operations."""
     @staticmethod
     def create(name, teacher_id):
-        group_id = str(uuid.uuid4())
+        group_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO groups (id, name, teacher_id, created_at) VALUES (?, ?, ?, ?)',
                       (group_id, name, teacher_id, datetime.now()))
@@ -270,7 +1231,7 @@ class Targets:
     """Manage targets table operations."""
     @staticmethod
     def create(student_id, subject, target):
-        target_id = str(uuid.uuid4())
+        target_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO targets (id, student_id, subject, target, created_at) VALUES (?, ?, ?, ?, ?)',
                       (target_id, student_id, subject, target, datetime.now()))
@@ -286,7 +1247,7 @@ class Remarks:
     """Manage remarks table operations."""
     @staticmethod
     def create(student_id, teacher_id, content):
-        remark_id = str(uuid.uuid4())
+        remark_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO remarks (id, student_id, teacher_id, content, created_at) VALUES (?, ?, ?, ?, ?)',
                       (remark_id, student_id, teacher_id, content, datetime.now()))
@@ -302,63 +1263,172 @@ class Notifications:
     """Manage notifications table operations."""
     @staticmethod
     def create(user_id, content):
-        notification_id = str(uuid.uuid4())
+        notification_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO notifications (id, user_id, content, created_at, is_read) VALUES (?, ?, ?, ?, ?)',
                       (notification_id, user_id, content, datetime.now(), 0))
         return notification_id
 
     @staticmethod
-    def get_by_user(user_id):
+    def create_many(records):
+        """Insert (id, user_id, content, created_at) records in one transaction."""
         with db_cursor() as c:
-            c.execute('SELECT id, content, created_at, is_read FROM notifications WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-            return c.fetchall()
+            c.executemany('INSERT INTO notifications (id, user_id, content, created_at, is_read) VALUES (?, ?, ?, ?, 0)', records)
+
+    @staticmethod
+    def get_by_user(user_id, limit=None, before=None, after=None):
+        with db_cursor() as c:
+            return keyset_query(c, 'SELECT id, content, created_at, is_read FROM notifications',
+                                'user_id = ?', (user_id,), limit, before, after, descending=True)
+
+    @staticmethod
+    def stream_by_user(user_id):
+        """Stream all of a user's notifications, newest first (see stream_keyset)."""
+        return stream_keyset('SELECT id, content, created_at, is_read FROM notifications', 'user_id = ?', (user_id,),
+                             descending=True)
 
     @staticmethod
     def mark_as_read(notification_id, user_id):
         with db_cursor() as c:
             c.execute('UPDATE notifications SET is_read = 1 WHERE id = ? AND user_id = ?', (notification_id, user_id))
 
+    @staticmethod
+    def mark_all_read(user_id, up_to=None):
+        """Mark a user's unread notifications read in one statement, optionally only those at or before cursor `up_to`."""
+        with db_cursor() as c:
+            if up_to:
+                created_at, row_id = decode_cursor(up_to)
+                c.execute('''UPDATE notifications SET is_read = 1
+                             WHERE user_id = ? AND is_read = 0 AND created_at <= ? AND (created_at < ? OR id <= ?)''',
+                          (user_id, created_at, created_at, row_id))
+            else:
+                c.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0', (user_id,))
+            return c.rowcount
+
+    @staticmethod
+    def unread_count(user_id):
+        with db_cursor() as c:
+            c.execute('SELECT unread FROM notification_counters WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+            return row['unread'] if row else 0
+
+    @staticmethod
+    def archive_read(older_than):
+        """Move read notifications created before `older_than` to notifications_archive; return how many moved."""
+        with db_cursor() as c:
+            c.execute('''INSERT OR IGNORE INTO notifications_archive (id, user_id, content, created_at, is_read, archived_at)
+                         SELECT id, user_id, content, created_at, is_read, ? FROM notifications
+                         WHERE is_read = 1 AND created_at < ?''', (datetime.now(), older_than))
+            c.execute('DELETE FROM notifications WHERE is_read = 1 AND created_at < ?', (older_than,))
+            return c.rowcount
+
+class Uploads:
+    """Manage uploads and upload_blobs table operations."""
+    @staticmethod
+    def create(filename, sha256, size, content_type, original_name=None):
+        with db_cursor() as c:
+            c.execute('''INSERT INTO upload_blobs (sha256, size, ref_count, created_at) VALUES (?, ?, 1, ?)
+                         ON CONFLICT (sha256) DO UPDATE SET ref_count = ref_count + 1''',
+                      (sha256, size, datetime.now()))
+            c.execute('INSERT INTO uploads (filename, sha256, size, content_type, original_name, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                      (filename, sha256, size, content_type, original_name, datetime.now()))
+
+    @staticmethod
+    def get_by_filename(filename):
+        with db_cursor() as c:
+            c.execute('SELECT filename, sha256, size, content_type, original_name, created_at FROM uploads WHERE filename = ?', (filename,))
+            return c.fetchone()
+
+    @staticmethod
+    def count_references(sha256):
+        with db_cursor() as c:
+            c.execute('SELECT ref_count FROM upload_blobs WHERE sha256 = ?', (sha256,))
+            row = c.fetchone()
+            return row['ref_count'] if row else 0
+
+    @staticmethod
+    def release(filename):
+        """Delete an upload record; return its sha256 if that was the blob's last reference."""
+        with db_cursor() as c:
+            c.execute('SELECT sha256 FROM uploads WHERE filename = ?', (filename,))
+            row = c.fetchone()
+            if not row:
+                return None
+            c.execute('DELETE FROM uploads WHERE filename = ?', (filename,))
+            c.execute('UPDATE upload_blobs SET ref_count = ref_count - 1 WHERE sha256 = ?', (row['sha256'],))
+            c.execute('DELETE FROM upload_blobs WHERE sha256 = ? AND ref_count <= 0', (row['sha256'],))
+            return row['sha256'] if c.rowcount else None
+
 class PrivateMessages:
     """Manage private_messages table operations."""
     @staticmethod
     def create(sender_id, receiver_id, content, msg_type):
-        message_id = str(uuid.uuid4())
+        message_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO private_messages (id, sender_id, receiver_id, content, type, created_at) VALUES (?, ?, ?, ?, ?, ?)',
                       (message_id, sender_id, receiver_id, content, msg_type, datetime.now()))
         return message_id
 
     @staticmethod
-    def get_by_user(user_id):
+    def get_by_user(user_id, limit=None, before=None, after=None):
         with db_cursor() as c:
-            c.execute('SELECT id, sender_id, receiver_id, content, type, created_at FROM private_messages WHERE sender_id = ? OR receiver_id = ?', (user_id, user_id))
-            return c.fetchall()
+            return keyset_query(c, 'SELECT id, sender_id, receiver_id, content, type, created_at FROM private_messages',
+                                '(sender_id = ? OR receiver_id = ?)', (user_id, user_id), limit, before, after)
+
+    @staticmethod
+    def stream_by_user(user_id):
+        """Stream all of a user's private messages, oldest first (see stream_keyset).
+
+        Written as a UNION ALL so SQLite merges the sender and receiver
+        indexes as it goes; the OR form sorts every row before returning one.
+        SQLite pushes each batch's resume condition down into both halves.
+        """
+        columns = 'id, sender_id, receiver_id, content, type, created_at'
+        return stream_keyset(f'''SELECT * FROM (SELECT {columns} FROM private_messages WHERE sender_id = ?
+                                               UNION ALL
+                                               SELECT {columns} FROM private_messages WHERE receiver_id = ? AND sender_id IS NOT ?)''',
+                             '1 = 1', (user_id, user_id, user_id))
 
 class Assignments:
     """Manage assignments table operations."""
     @staticmethod
     def create(student_id, teacher_id, title, file_path, status='Submitted'):
-        assignment_id = str(uuid.uuid4())
+        assignment_id = new_id()
         with db_cursor() as c:
             c.execute('INSERT INTO assignments (id, student_id, teacher_id, title, file_path, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
                       (assignment_id, student_id, teacher_id, title, file_path, status, datetime.now()))
         return assignment_id
 
     @staticmethod
-    def get_by_user(user_id, role='student'):
+    def get_by_user(user_id, role='student', limit=None, before=None, after=None):
         with db_cursor() as c:
-            if role == 'student':
-                c.execute('SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments WHERE student_id = ?', (user_id,))
-            else:
-                c.execute('SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments WHERE teacher_id = ?', (user_id,))
-            return c.fetchall()
+            where = 'student_id = ?' if role == 'student' else 'teacher_id = ?'
+            return keyset_query(c, 'SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments',
+                                where, (user_id,), limit, before, after)
 
     @staticmethod
-    def get_all():
+    def get_all(limit=None, before=None, after=None):
         with db_cursor() as c:
-            c.execute('SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments')
-            return c.fetchall()
+            return keyset_query(c, 'SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments',
+                                '1 = 1', (), limit, before, after)
+
+    @staticmethod
+    def stream(user_id=None, role='student'):
+        """Stream assignments oldest first, everyone's or one user's (see stream_keyset)."""
+        where, params = '1 = 1', ()
+        if user_id:
+            where, params = ('student_id = ?' if role == 'student' else 'teacher_id = ?'), (user_id,)
+        return stream_keyset('SELECT id, student_id, teacher_id, title, file_path, status, created_at FROM assignments',
+                             where, params)
+
+    @staticmethod
+    def delete_by_student(student_id):
+        """Delete a student's assignments and return their file names, so the caller can release them."""
+        with db_cursor() as c:
+            c.execute('SELECT file_path FROM assignments WHERE student_id = ?', (student_id,))
+            files = [row['file_path'] for row in c.fetchall()]
+            c.execute('DELETE FROM assignments WHERE student_id = ?', (student_id,))
+        return files
 
     @staticmethod
     def update_status(assignment_id, status):
@@ -0,0 +1,247 @@
+"""Background writers that persist notifications and chat messages in batches."""
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from model import Notifications, Messages, new_id
+
+_STOP = object()
+# The database rejects the record itself; writing it again cannot succeed.
+PERMANENT_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+class NotStored(Exception):
+    """A record was not stored within the caller's wait; it stays queued and is written later."""
+    def __init__(self, record_id):
+        super().__init__(f'record {record_id} is not stored yet')
+        self.record_id = record_id
+
+class BatchWriter:
+    """Queue records and store them with `write(batch)` off the request path.
+
+    A single worker drains the bounded queue, coalescing whatever arrives within
+    `flush_interval` (up to `batch_size` records) into one `write` call, and
+    only then calls `emit(record)` for each record, if given. When the queue
+    stays full for `put_timeout` seconds the caller writes its record inline
+    instead, so records are slowed down under pressure rather than lost.
+
+    A failed batch is retried `retries` times and then written one record at a
+    time. Records that still fail (a locked database, an exhausted pool) are
+    kept and retried ahead of the next batch. Only records the database rejects
+    outright, such as constraint violations, are dropped; `dropped` counts them.
+    With `synchronous=True` every put writes and emits inline (used by tests).
+    """
+    name = 'batch-writer'
+
+    def __init__(self, write, emit=None, max_queue=1000, batch_size=200, flush_interval=0.05, put_timeout=0.5,
+                 retries=2, retry_delay=0.2, synchronous=False):
+        self.write = write
+        self.emit = emit
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.synchronous = synchronous
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pending = []  # records whose write failed, retried before the next batch
+        self._waiters = {}  # record id -> [Event, error] for callers of put(wait=...)
+        self._counters = {'submitted': 0, 'written': 0, 'batches': 0, 'largest_batch': 0,
+                          'inline_writes': 0, 'errors': 0, 'retries': 0, 'dropped': 0, 'high_water': 0}
+
+    def put(self, record, wait=None):
+        """Queue a record whose first field is its id, and return that id.
+
+        With `wait`, block until the record is stored and emitted. Raise NotStored
+        if that takes longer than `wait` seconds, or the database's error if it
+        rejected the record.
+        """
+        waiter = None
+        with self._lock:
+            self._counters['submitted'] += 1
+            if wait is not None:
+                waiter = self._waiters[record[0]] = [threading.Event(), None]
+        if self.synchronous:
+            self._write_inline(record)
+        else:
+            self._ensure_worker()
+            try:
+                self._queue.put(record, timeout=self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self._counters['inline_writes'] += 1
+                self._write_inline(record)
+            with self._lock:
+                self._counters['high_water'] = max(self._counters['high_water'], self._queue.qsize())
+        if waiter is not None:
+            if not waiter[0].wait(wait):
+                with self._lock:
+                    self._waiters.pop(record[0], None)
+                raise NotStored(record[0])
+            if waiter[1] is not None:
+                raise waiter[1]
+        return record[0]
+
+    def _write_inline(self, record):
+        failed = self._store([record])
+        if not failed:
+            return
+        with self._lock:
+            keep = not self.synchronous and len(self._pending) < self.max_queue
+            if keep:
+                self._pending.append(record)
+            else:
+                self._waiters.pop(record[0], None)
+        if not keep:
+            raise failed[0][1]
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def _take(self, timeout):
+        """Return up to batch_size queued records, the first waited for up to `timeout` seconds, and whether _STOP came."""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if record is _STOP:
+                return batch, True
+            batch.append(record)
+            timeout = self.flush_interval
+        return batch, False
+
+    def _run(self):
+        while True:
+            with self._lock:
+                retry = list(self._pending)
+            # With records to retry, don't block on an empty queue.
+            batch, stop = self._take(self.retry_delay if retry else None)
+            failed = self._store(retry + batch) if retry or batch else []
+            with self._lock:
+                # Retried records stay pending until stored, so flush() waits for them.
+                self._pending[:len(retry)] = [record for record, _ in failed]
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                if failed:
+                    print(f'{self.name}: stopped with {len(failed)} records unwritten')
+                return
+
+    def _store(self, batch):
+        """Write batch, retrying it and then falling back to one record at a time.
+
+        Stored records are emitted and dropped ones counted. Return the
+        (record, error) pairs that failed with an error worth retrying later.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * attempt)
+                with self._lock:
+                    self._counters['retries'] += 1
+            try:
+                self.write(batch)
+            except Exception as e:
+                error = e
+                with self._lock:
+                    self._counters['errors'] += 1
+                if isinstance(e, PERMANENT_ERRORS):
+                    break
+                continue
+            self._stored(batch)
+            return []
+        if len(batch) == 1:
+            outcomes = [(batch[0], error)]
+        else:
+            print(f'{self.name}: failed to write {len(batch)} records ({error}); writing them one at a time')
+            outcomes = []
+            for record in batch:
+                try:
+                    self.write([record])
+                except Exception as e:
+                    outcomes.append((record, e))
+                else:
+                    self._stored([record])
+        failed = []
+        for record, e in outcomes:
+            if isinstance(e, PERMANENT_ERRORS):
+                self._dropped(record, e)
+            else:
+                failed.append((record, e))
+        return failed
+
+    def _stored(self, batch):
+        with self._lock:
+            self._counters['written'] += len(batch)
+            self._counters['batches'] += 1
+            self._counters['largest_batch'] = max(self._counters['largest_batch'], len(batch))
+        for record in batch:
+            if self.emit is not None:
+                try:
+                    self.emit(record)
+                except Exception as e:
+                    print(f'{self.name}: failed to emit {record[0]}: {e}')
+            self._release(record, None)
+
+    def _dropped(self, record, error):
+        with self._lock:
+            self._counters['dropped'] += 1
+        print(f'{self.name}: dropped {record[0]}: {error}')
+        self._release(record, error)
+
+    def _release(self, record, error):
+        with self._lock:
+            waiter = self._waiters.pop(record[0], None)
+        if waiter is not None:
+            waiter[1] = error
+            waiter[0].set()
+
+    def flush(self):
+        """Block until everything queued so far has been written."""
+        if self._worker is not None:
+            self._queue.join()
+            while self._pending and self._worker.is_alive():
+                time.sleep(self.retry_delay)
+
+    def stop(self):
+        """Flush pending records and stop the worker."""
+        with self._lock:
+            worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(_STOP)
+            worker.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, queued=self._queue.qsize(), pending=len(self._pending), capacity=self._queue.maxsize)
+
+class NotificationWriter(BatchWriter):
+    """Store notifications in batches, then push each one to its user."""
+    name = 'notification-writer'
+
+    def __init__(self, emit, **kwargs):
+        super().__init__(Notifications.create_many, emit, **kwargs)
+
+    def submit(self, user_id, content):
+        """Queue a notification for user_id and return its id."""
+        return self.put((new_id(), user_id, content, datetime.now()))
+
+class MessageWriter(BatchWriter):
+    """Group-commit chat messages, then fan each one out to its room."""
+    name = 'message-writer'
+
+    def __init__(self, emit, **kwargs):
+        super().__init__(Messages.create_many, emit, **kwargs)
+
+    def submit(self, chatroom_id, user_id, content, msg_type, wait=None):
+        """Queue a chat message and return its record (see BatchWriter.put for `wait`)."""
+        record = (new_id(), chatroom_id, user_id, content, msg_type, datetime.now())
+        self.put(record, wait)
+        return record
@@ -0,0 +1,97 @@
+"""Password hashing in a bounded process pool, so slow KDFs don't block request workers."""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Any method werkzeug understands, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+# Hash/verify jobs allowed to wait or run at once before new ones are refused.
+PASSWORD_MAX_PENDING = int(os.environ.get('PASSWORD_MAX_PENDING', 64))
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 5))
+# 'inline' hashes in the calling thread (tests, or hosts where forking is unwanted).
+PASSWORD_POOL = os.environ.get('PASSWORD_POOL', 'process')
+
+class HashingBusy(Exception):
+    """Raised when too many hashing jobs are already pending."""
+
+def _timed(func, *args):
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+class PasswordHasher:
+    """Hash and verify passwords in a process pool with queueing metrics."""
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING,
+                 queue_timeout=PASSWORD_QUEUE_TIMEOUT, inline=PASSWORD_POOL == 'inline'):
+        self.method = method
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.inline = inline
+        # Werkzeug expands bare method names ('scrypt') to their full parameters.
+        self.prefix = generate_password_hash('', method).split('$', 1)[0]
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'rejected': 0, 'rehashed': 0, 'max_pending': 0,
+                          'queue_seconds': 0.0, 'run_seconds': 0.0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise HashingBusy('Too many password operations in progress')
+        submitted = time.time()
+        with self._lock:
+            self._counters['submitted'] += 1
+            self._pending += 1
+            self._counters['max_pending'] = max(self._counters['max_pending'], self._pending)
+        try:
+            if self.inline:
+                result, started, finished = _timed(func, *args)
+            else:
+                result, started, finished = self._get_executor().submit(_timed, func, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+        with self._lock:
+            self._counters['completed'] += 1
+            self._counters['queue_seconds'] += max(0.0, started - submitted)
+            self._counters['run_seconds'] += finished - started
+        return result
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when pwhash was made with different parameters than the configured method."""
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def note_rehash(self):
+        with self._lock:
+            self._counters['rehashed'] += 1
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, pending=self._pending, workers=self.workers, method=self.prefix)
+
+hasher = PasswordHasher()
@@ -0,0 +1,247 @@
+"""Cross-worker message queues for Socket.IO.
+
+With more than one worker process each worker only knows its own sockets, so
+emits, room changes and cache updates have to travel through a shared queue.
+SOCKETIO_MESSAGE_QUEUE picks the backend:
+
+    redis://host:6379/0          Redis pub/sub (needs the redis package)
+    amqp://..., kafka://...      brokers python-socketio supports via kombu/kafka
+    zmq+tcp://host:5555+5556     ZeroMQ forwarder
+    local:///tmp/socketio.sock   LocalBroker over a Unix socket (one host only)
+
+Clients must stick to one worker for the life of a polling session; see
+gunicorn.conf.py for the sticky-session notes.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import socketio
+
+LOCAL_PREFIX = 'local://'
+SUBSCRIBE = b'SUBSCRIBE\n'
+
+class BroadcastMixin:
+    """Adds app-level topics to a python-socketio pub/sub manager.
+
+    broadcast(topic, *args) runs the handlers registered with on(topic, ...) in
+    every other worker; the sending worker is expected to have done the work
+    locally already.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.topics = {}
+        self.counters = {'published': 0, 'received': 0, 'handler_errors': 0}
+
+    def on(self, topic, handler):
+        self.topics.setdefault(topic, []).append(handler)
+
+    def broadcast(self, topic, *args):
+        self.counters['published'] += 1
+        self._publish({'method': 'broadcast', 'topic': topic, 'args': list(args), 'host_id': self.host_id})
+
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except ValueError:
+                    continue
+            if isinstance(data, dict) and data.get('method') == 'broadcast':
+                if data.get('host_id') != self.host_id:
+                    self.counters['received'] += 1
+                    self._dispatch(data.get('topic'), data.get('args') or [])
+                continue
+            yield data
+
+    def _dispatch(self, topic, args):
+        for handler in self.topics.get(topic, ()):
+            try:
+                handler(*args)
+            except Exception as e:
+                self.counters['handler_errors'] += 1
+                print(f'Error handling broadcast {topic}: {e}')
+
+    def stats(self):
+        return dict(self.counters, backend=self.name, host_id=self.host_id)
+
+class LocalBroker:
+    """Fan-out hub on a Unix socket: every line a publisher writes is sent to all subscribers.
+
+    Messages are newline-delimited JSON. A connection whose first line is
+    SUBSCRIBE only receives; any other connection only publishes, so it never
+    has unread data piling up. Run one broker per host, either from
+    gunicorn's master (gunicorn.conf.py does this for local:// queues) or with
+    `python pubsub.py /tmp/socketio.sock`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self.counters = {'connections': 0, 'messages': 0, 'dropped_subscribers': 0}
+
+    def start(self):
+        """Bind the socket and serve from a daemon thread."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(128)
+        threading.Thread(target=self._accept, name='pubsub-broker', daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.counters['connections'] += 1
+            threading.Thread(target=self._relay, args=(conn,), daemon=True).start()
+
+    def _relay(self, conn):
+        with conn.makefile('rb') as lines:
+            try:
+                for line in lines:
+                    if line == SUBSCRIBE:
+                        with self._lock:
+                            self._subscribers.add(conn)
+                    else:
+                        self._fan_out(line)
+            except OSError:
+                pass
+        self._drop(conn)
+
+    def _fan_out(self, line):
+        with self._lock:
+            self.counters['messages'] += 1
+            subscribers = list(self._subscribers)
+        for conn in subscribers:
+            try:
+                conn.sendall(line)
+            except OSError:
+                self._drop(conn)
+
+    def _drop(self, conn):
+        with self._lock:
+            if conn in self._subscribers:
+                self._subscribers.discard(conn)
+                self.counters['dropped_subscribers'] += 1
+        conn.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, set()
+        for conn in subscribers:
+            conn.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """Socket.IO client manager that talks to a LocalBroker.
+
+    Meant for tests and for several workers on a single host. `channel` is not
+    used: run one broker per application.
+    """
+    name = 'local'
+
+    def __init__(self, url=LOCAL_PREFIX + '/tmp/socketio.sock', channel='socketio', write_only=False,
+                 logger=None, json=None, reconnect_delay=1.0):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len(LOCAL_PREFIX):] if url.startswith(LOCAL_PREFIX) else url
+        self.reconnect_delay = reconnect_delay
+        self._conn = None
+        self._conn_lock = threading.Lock()
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.path)
+        return conn
+
+    def _publish(self, data):
+        line = (self.json.dumps(data) + '\n').encode()
+        with self._conn_lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = self._connect()
+                    self._conn.sendall(line)
+                    return
+                except OSError as e:
+                    if self._conn is not None:
+                        self._conn.close()
+                        self._conn = None
+                    if attempt:
+                        print(f'Cannot publish to local broker at {self.path}: {e}')
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self._connect()
+                conn.sendall(SUBSCRIBE)
+            except OSError:
+                time.sleep(self.reconnect_delay)
+                continue
+            with conn, conn.makefile('rb') as lines:
+                try:
+                    yield from lines
+                except OSError:
+                    pass
+            time.sleep(self.reconnect_delay)
+
+class LocalManager(BroadcastMixin, LocalPubSubManager):
+    pass
+
+class RedisManager(BroadcastMixin, socketio.RedisManager):
+    pass
+
+class KombuManager(BroadcastMixin, socketio.KombuManager):
+    pass
+
+class KafkaManager(BroadcastMixin, socketio.KafkaManager):
+    pass
+
+class ZmqManager(BroadcastMixin, socketio.ZmqManager):
+    pass
+
+def make_manager(url, write_only=False):
+    """Return a client manager for the message queue at `url`, or None to keep emits in-process."""
+    if not url:
+        return None
+    if url.startswith(LOCAL_PREFIX):
+        cls = LocalManager
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        cls = RedisManager
+    elif url.startswith('kafka://'):
+        cls = KafkaManager
+    elif url.startswith('zmq'):
+        cls = ZmqManager
+    else:
+        cls = KombuManager
+    return cls(url, write_only=write_only)
+
+def sync_cache(manager, topic, target):
+    """Mirror `target`'s local updates to the other workers' copies through `manager`.
+
+    The target calls target.publish(op, *args) after each local write; other
+    workers replay it as target.<op>(*args, broadcast=False).
+    """
+    target.publish = lambda op, *args: manager.broadcast(topic, op, *args)
+    manager.on(topic, lambda op, *args: getattr(target, op)(*args, broadcast=False))
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else '/tmp/socketio.sock'
+    broker = LocalBroker(path).start()
+    print(f'Local Socket.IO broker listening on {path}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.close()
@@ -0,0 +1,145 @@
+"""Full-text search over chat messages, private messages and remarks.
+
+The FTS5 indexes and the triggers that keep them current come from
+migrations.SEARCH_SOURCES. Every indexed row carries scope tokens naming who
+may see it, so search() restricts matches to the caller's chatrooms,
+conversations and students inside the index rather than filtering hits after
+ranking them all.
+"""
+import html
+import os
+import re
+import sqlite3
+from model import db_cursor
+
+SOURCES = ('messages', 'private_messages', 'remarks')
+SNIPPET_TOKENS = int(os.environ.get('SEARCH_SNIPPET_TOKENS', 12))
+
+# Columns of the source row returned with each hit.
+SOURCE_FIELDS = {
+    'messages': ('id', 'chatroom_id', 'user_id', 'type', 'created_at'),
+    'private_messages': ('id', 'sender_id', 'receiver_id', 'type', 'created_at'),
+    'remarks': ('id', 'student_id', 'teacher_id', 'created_at'),
+}
+
+# A quoted phrase (the closing quote may be missing) or a bare word, possibly ending in *.
+TERM = re.compile(r'"([^"]*)"?|([^\s"]+)')
+WORD = re.compile(r'\w+')
+
+def match_expression(text):
+    """Turn free text into an FTS5 query, or None if it has no words.
+
+    Every word must occur; quoted phrases must occur in order and a trailing *
+    matches a prefix. Anything else, FTS5 operators included, is plain text.
+    """
+    terms = []
+    for phrase, word in TERM.findall(text):
+        words = WORD.findall(phrase or word)
+        if words:
+            terms.append('"' + ' '.join(words) + '"' + ('*' if word.endswith('*') else ''))
+    return ' '.join(terms) or None
+
+def scope_token(prefix, row_id):
+    """The scope token migrations.SEARCH_SOURCES indexes for a chatroom ('s') or user ('u') id, quoted."""
+    return '"' + prefix + str(row_id).replace('-', '').replace('"', '""') + '"'
+
+def caller_scopes(user):
+    """Scope tokens per source: the user's chatrooms, their own conversations and the remarks they may read.
+
+    Teachers see remarks they wrote and remarks on their students; students
+    see remarks about themselves.
+    """
+    with db_cursor() as c:
+        c.execute('''SELECT id FROM chatrooms WHERE teacher_id = ?
+                     UNION SELECT chatroom_id FROM chatroom_members WHERE user_id = ?''', (user['id'], user['id']))
+        rooms = [scope_token('s', row[0]) for row in c.fetchall()]
+        students = []
+        if user['role'] == 'teacher':
+            c.execute('SELECT id FROM students WHERE teacher_id = ?', (user['id'],))
+            students = [scope_token('u', row[0]) for row in c.fetchall()]
+    me = scope_token('u', user['id'])
+    return {'messages': rooms, 'private_messages': [me], 'remarks': [me] + students}
+
+def _snippet(text):
+    """HTML-escape a snippet and turn its \\x02/\\x03 markers into <mark> tags."""
+    return html.escape(text or '', quote=False).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+def _search_source(c, source, query, scopes, count, recent):
+    fields = SOURCE_FIELDS[source]
+    fts = f'{source}_fts'
+    match = f'content : ({query}) AND scope : ({" OR ".join(scopes)})'
+    # Ranking reads every hit's statistics; newest-first stops after `count` hits.
+    rank, order = ('NULL', 'rowid DESC') if recent else ('rank', 'rank')
+    c.execute(f'''SELECT {", ".join("t." + f for f in fields)}, h.snippet, h.rank
+                  FROM (SELECT rowid, {rank} AS rank, snippet({fts}, 0, char(2), char(3), '…', ?) AS snippet
+                        FROM {fts} WHERE {fts} MATCH ? ORDER BY {order} LIMIT ?) h
+                  JOIN {source} t ON t.rowid = h.rowid''', (SNIPPET_TOKENS, match, count))
+    hits = []
+    for row in c.fetchall():
+        hit = {'source': source, **{f: row[f] for f in fields}, 'snippet': _snippet(row['snippet'])}
+        if not recent:
+            hit['score'] = round(-row['rank'], 4)
+        hits.append(hit)
+    return hits
+
+def search(user, text, limit, offset=0, sources=SOURCES, recent=False):
+    """Return (hits, next_offset) for a user's query across `sources`.
+
+    Hits are ranked by BM25 score, or newest first when `recent` is set (much
+    cheaper for words found in a large share of all messages). Each source
+    is asked for its first offset + limit + 1 hits, which are merged and
+    sliced; next_offset is None on the last page. Returns None when `text`
+    has no words.
+    """
+    query = match_expression(text)
+    if query is None:
+        return None
+    scopes = caller_scopes(user)
+    hits = []
+    with db_cursor() as c:
+        for source in sources:
+            if scopes[source]:
+                hits += _search_source(c, source, query, scopes[source], offset + limit + 1, recent)
+    if recent:
+        hits.sort(key=lambda h: (str(h['created_at']), h['id']), reverse=True)
+    else:
+        hits.sort(key=lambda h: -h['score'])
+    page = hits[offset:offset + limit]
+    return page, offset + limit if len(hits) > offset + limit else None
+
+def rebuild():
+    """Rebuild every search index from its table and merge it into one segment; return rows per table.
+
+    Needed after writes that bypassed the triggers, or after VACUUM, which may
+    renumber the rowids the indexes refer to.
+    """
+    counts = {}
+    with db_cursor() as c:
+        for source in SOURCES:
+            c.execute(f"INSERT INTO {source}_fts({source}_fts) VALUES ('rebuild')")
+            c.execute(f"INSERT INTO {source}_fts({source}_fts) VALUES ('optimize')")
+            c.execute(f'SELECT COUNT(*) FROM {source}')
+            counts[source] = c.fetchone()[0]
+    return counts
+
+def check():
+    """Return the sources whose index is damaged or doesn't cover exactly the rows of its table.
+
+    Rows are compared by rowid against the index's docsize table, which
+    catches writes that bypassed the triggers. Text edited behind the
+    triggers' back is only noticed by SQLite versions whose integrity-check
+    reads the content table.
+    """
+    stale = []
+    with db_cursor() as c:
+        for source in SOURCES:
+            c.execute(f'''SELECT EXISTS (SELECT rowid FROM {source} EXCEPT SELECT id FROM {source}_fts_docsize)
+                              OR EXISTS (SELECT id FROM {source}_fts_docsize EXCEPT SELECT rowid FROM {source})''')
+            missing = c.fetchone()[0]
+            try:
+                c.execute(f"INSERT INTO {source}_fts({source}_fts, rank) VALUES ('integrity-check', 1)")
+            except sqlite3.DatabaseError:
+                missing = True
+            if missing:
+                stale.append(source)
+    return stale
@@ -0,0 +1,90 @@
+"""Synthetic school data for benchmarks and local testing, written through the model classes.
+
+Every account gets the same password (hashed once), teachers are
+teacher<N>@school.test and students student<N>@school.test, so benchmarks can
+log in and find their targets without extra bookkeeping. The same `seed`
+always produces the same names, scores and message texts.
+"""
+import random
+from datetime import datetime, timedelta
+from model import (
+    Users, Students, Grades, Chatrooms, ChatroomMembers, Messages, Notifications,
+    Remarks, Targets, student_grading, db_cursor, new_id
+)
+
+SUBJECTS = ('Mathematics', 'English', 'Physics', 'Chemistry', 'Biology', 'History', 'Geography', 'Art')
+FIRST_NAMES = ('Amina', 'Brian', 'Chen', 'Diana', 'Emeka', 'Fatma', 'George', 'Hana', 'Ivan', 'Joy', 'Kofi', 'Lina')
+LAST_NAMES = ('Otieno', 'Smith', 'Wang', 'Garcia', 'Okafor', 'Yilmaz', 'Brown', 'Sato', 'Petrov', 'Mwangi')
+WORDS = ('homework', 'exam', 'notes', 'chapter', 'question', 'deadline', 'project', 'lab', 'revision', 'quiz',
+         'tomorrow', 'please', 'thanks', 'group', 'page', 'answer')
+
+def _name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+def _sentence(rng, words=8):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, words))).capitalize()
+
+def generate(password_hash, students=1000, students_per_teacher=30, grades_per_student=6, chatrooms_per_teacher=2,
+             messages_per_room=200, notifications_per_user=20, remarks_per_student=2, targets_per_student=2,
+             seed=42, progress=None):
+    """Populate the database and return a dict of row counts.
+
+    Each teacher's class is written in one transaction. `progress`, if
+    given, is called with the number of students written so far.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    grades_per_student = min(grades_per_student, len(SUBJECTS))
+    counts = dict.fromkeys(('teachers', 'students', 'grades', 'chatrooms', 'messages', 'notifications', 'remarks', 'targets'), 0)
+    teacher_count = max(1, -(-students // students_per_teacher))
+    written = 0
+    for t in range(teacher_count):
+        class_size = min(students_per_teacher, students - written)
+        with db_cursor():
+            teacher_id = Users.create(_name(rng), f'teacher{t}@school.test', password_hash, 'teacher')
+            counts['teachers'] += 1
+            class_ids = []
+            grade_rows = []
+            for _ in range(class_size):
+                n = written + len(class_ids)
+                name = _name(rng)
+                student_id = Users.create(name, f'student{n}@school.test', password_hash, 'student')
+                Students.create(student_id, name, f'student{n}@school.test', teacher_id)
+                class_ids.append(student_id)
+                for subject in rng.sample(SUBJECTS, grades_per_student):
+                    score = max(0, min(100, int(rng.gauss(62, 16))))
+                    grade_rows.append((student_id, subject, score, student_grading(score)))
+                for subject in rng.sample(SUBJECTS, min(targets_per_student, len(SUBJECTS))):
+                    Targets.create(student_id, subject, rng.randint(50, 95))
+                for _ in range(remarks_per_student):
+                    Remarks.create(student_id, teacher_id, _sentence(rng))
+            Grades.create_many(grade_rows)
+            counts['students'] += len(class_ids)
+            counts['grades'] += len(grade_rows)
+            counts['targets'] += len(class_ids) * min(targets_per_student, len(SUBJECTS))
+            counts['remarks'] += len(class_ids) * remarks_per_student
+
+            members = [teacher_id] + class_ids
+            for r in range(chatrooms_per_teacher):
+                chatroom_id = Chatrooms.create(f'Class {t} room {r}', teacher_id)
+                for student_id in class_ids:
+                    ChatroomMembers.add(chatroom_id, student_id)
+                start = now - timedelta(days=30)
+                step = timedelta(days=30) / max(1, messages_per_room)
+                times = [start + step * i for i in range(messages_per_room)]
+                Messages.create_many([(new_id(at=at), chatroom_id, rng.choice(members), _sentence(rng, 14), 'text', at) for at in times])
+                counts['chatrooms'] += 1
+                counts['messages'] += messages_per_room
+
+            records = []
+            for user_id in members:
+                start = now - timedelta(days=60)
+                for i in range(notifications_per_user):
+                    created_at = start + timedelta(hours=i * 3)
+                    records.append((new_id(at=created_at), user_id, _sentence(rng), created_at))
+            Notifications.create_many(records)
+            counts['notifications'] += len(records)
+        written += class_size
+        if progress:
+            progress(written)
+    return counts
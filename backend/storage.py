@@ -0,0 +1,114 @@
+"""Content-addressed storage for uploaded files."""
+import hashlib
+import mimetypes
+import os
+import tempfile
+from model import Uploads, BASE_DIR, db_cursor, pool
+
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', os.path.join(BASE_DIR, 'uploads'))
+BLOB_DIR = os.path.join(UPLOAD_DIR, 'blobs')
+TMP_DIR = os.path.join(UPLOAD_DIR, 'tmp')
+CHUNK_SIZE = 64 * 1024
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds its size limit."""
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+def save_stream(stream, filename, max_bytes, original_name=None):
+    """Store `stream` under the public name `filename` and return its sha256.
+
+    The stream is copied in CHUNK_SIZE pieces to a temp file while it is
+    hashed, so neither size checks nor dedup need the whole file in memory.
+    Identical content is stored once; each filename holds a reference to it.
+    The blob file is placed before the reference is committed, while the
+    transaction holds SQLite's write lock, so a release() in any process
+    cannot delete it in between.
+    """
+    os.makedirs(TMP_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f'File exceeds {max_bytes // (1024 * 1024)} MB limit')
+                digest.update(chunk)
+                tmp.write(chunk)
+        sha256 = digest.hexdigest()
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        with db_cursor():
+            # The first write takes the database write lock, held until this block commits.
+            Uploads.create(filename, sha256, size, content_type, original_name)
+            path = blob_path(sha256)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        return sha256
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def release(filename):
+    """Drop `filename`'s reference and delete the blob once nothing points at it.
+
+    Call it inside the transaction that removes the row naming the file, so
+    both commit or roll back together. The blob is moved aside while the
+    transaction holds the write lock, so a save_stream() of the same content
+    waits and then stores it afresh. Once the outermost transaction ends the
+    blob is deleted, or put back if a rollback kept its reference.
+    """
+    with db_cursor():
+        orphan = Uploads.release(filename)
+        if orphan and os.path.exists(blob_path(orphan)):
+            os.replace(blob_path(orphan), blob_path(orphan) + '.deleted')
+            pool.defer(lambda: _finish_release(orphan))
+
+def _finish_release(sha256):
+    path = blob_path(sha256)
+    doomed = path + '.deleted'
+    if not os.path.exists(doomed):
+        return
+    if Uploads.count_references(sha256):
+        os.replace(doomed, path)
+    else:
+        os.remove(doomed)
+
+def path_for(filename):
+    """Return (path, sha256) for a public filename, or (None, None) if it does not exist.
+
+    Files uploaded before content-addressed storage live directly in UPLOAD_DIR
+    and have no recorded hash.
+    """
+    upload = Uploads.get_by_filename(filename)
+    if upload:
+        return blob_path(upload['sha256']), upload['sha256']
+    legacy = os.path.join(UPLOAD_DIR, os.path.basename(filename))
+    return (legacy, None) if os.path.isfile(legacy) else (None, None)
+
+def import_legacy():
+    """Move files stored directly in UPLOAD_DIR into content-addressed storage.
+
+    Returns (imported, duplicates), where duplicates counts files whose
+    content was already stored under another name.
+    """
+    imported = duplicates = 0
+    for name in sorted(os.listdir(UPLOAD_DIR)):
+        path = os.path.join(UPLOAD_DIR, name)
+        if not os.path.isfile(path) or Uploads.get_by_filename(name):
+            continue
+        with open(path, 'rb') as f:
+            sha256 = save_stream(f, name, float('inf'), original_name=name)
+        duplicates += Uploads.count_references(sha256) > 1
+        imported += 1
+        os.remove(path)
+    return imported, duplicates
@@ -0,0 +1,25 @@
+"""Test setup: the backend modules read their settings when imported, so set them first."""
+import os
+import sys
+import tempfile
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ['ASYNC_MODE'] = 'threading'
+TMP_DIR = tempfile.mkdtemp(prefix='grade-manager-tests-')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'test.db')
+os.environ['UPLOAD_DIR'] = os.path.join(TMP_DIR, 'uploads')
+os.environ['THUMBNAIL_POOL'] = 'thread'
+os.environ.setdefault('SECRET_KEY', 'tests')
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Point the model at a freshly migrated database in tmp_path."""
+    import migrations
+    import model
+    model.pool.close_all()
+    monkeypatch.setattr(model, 'DB_PATH', str(tmp_path / 'test.db'))
+    migrations.upgrade()
+    yield model.DB_PATH
+    model.pool.close_all()
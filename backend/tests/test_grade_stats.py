@@ -0,0 +1,47 @@
+"""The trigger-maintained grade aggregates must match a rebuild from the grades table."""
+from datetime import datetime, timedelta
+import pytest
+import model
+
+def make_student():
+    teacher_id = model.Users.create('Teacher', 'teacher@school.test', '!', 'teacher')
+    student_id = model.Users.create('Student', 'student@school.test', '!', 'student')
+    model.Students.create(student_id, 'Student', 'student@school.test', teacher_id)
+    return student_id
+
+def add_grade(student_id, score, at):
+    with model.db_cursor() as c:
+        c.execute('INSERT INTO grades (id, student_id, subject, score, grade, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                  (model.new_id(at=at), student_id, 'Mathematics', score, model.student_grading(score), at))
+
+def rebuilt(student_id):
+    model.GradeStats.rebuild()
+    return tuple(model.GradeStats.for_student(student_id))
+
+def test_back_dated_grades_update_first7(database):
+    student_id = make_student()
+    now = datetime.now()
+    for n in range(8):
+        add_grade(student_id, 50, now + timedelta(minutes=n))
+    # Older than every grade so far: it becomes one of the first 7 and pushes the 7th out.
+    add_grade(student_id, 100, now - timedelta(days=30))
+    stats = tuple(model.GradeStats.for_student(student_id))
+    assert stats[4:] == (100 + 6 * 50, 7)
+    assert stats == rebuilt(student_id)
+
+def test_out_of_order_grades_below_seven(database):
+    student_id = make_student()
+    now = datetime.now()
+    for n, score in enumerate((40, 90, 70)):
+        add_grade(student_id, score, now - timedelta(days=n))
+    stats = tuple(model.GradeStats.for_student(student_id))
+    assert stats[4:] == (200, 3)
+    assert stats == rebuilt(student_id)
+
+def test_null_score_is_rejected(database):
+    student_id = make_student()
+    with pytest.raises(ValueError):
+        model.Grades.create(student_id, 'Mathematics', None, 'E')
+    with pytest.raises(ValueError):
+        model.Grades.create_many([(student_id, 'Mathematics', 80, 'A'), (student_id, 'English', None, 'E')])
+    assert model.GradeStats.for_student(student_id) is None
@@ -0,0 +1,13 @@
+"""Every lookup in migrations.INDEXED_LOOKUPS must SEARCH its index instead of scanning."""
+import migrations
+import model
+
+def test_lookups_use_their_indexes(database):
+    assert migrations.check_query_plans() == []
+
+def test_dropped_index_is_reported(database):
+    with model.db_cursor() as c:
+        c.execute('DROP INDEX idx_students_teacher')
+    failures = migrations.check_query_plans()
+    assert [sql for sql, _ in failures] == ['SELECT id FROM students WHERE teacher_id = ?']
+    assert any(step.startswith('SCAN students') for step in failures[0][1])
@@ -0,0 +1,56 @@
+"""Upload blobs are released together with the last row that names them."""
+import io
+import os
+import pytest
+import model
+import storage
+
+def store(name, content):
+    return storage.save_stream(io.BytesIO(content), name, 1024 * 1024, original_name=name)
+
+def make_student():
+    teacher_id = model.Users.create('Teacher', 'teacher@school.test', '!', 'teacher')
+    student_id = model.Users.create('Student', 'student@school.test', '!', 'student')
+    model.Students.create(student_id, 'Student', 'student@school.test', teacher_id)
+    return teacher_id, student_id
+
+@pytest.fixture
+def client(database):
+    import app
+    return app.app.test_client()
+
+def test_deleting_a_student_releases_photo_and_assignments(client):
+    teacher_id, student_id = make_student()
+    photo = store('photo.png', b'photo')
+    model.Users.set_profile_photo(student_id, 'photo.png')
+    essay = store('essay.pdf', b'essay')
+    model.Assignments.create(student_id, teacher_id, 'Essay', 'essay.pdf')
+    shared = store('shared.pdf', b'photo')  # same content as the photo, under another name
+
+    assert client.delete(f'/api/students/{student_id}').status_code == 200
+    assert not os.path.exists(storage.blob_path(essay))
+    assert model.Uploads.get_by_filename('photo.png') is None
+    # The photo's blob is still referenced by shared.pdf.
+    assert shared == photo and os.path.exists(storage.blob_path(photo))
+    assert model.Uploads.count_references(photo) == 1
+
+def test_replacing_a_photo_releases_the_old_one(client):
+    _, student_id = make_student()
+    old = store('old.png', b'old photo')
+    model.Users.set_profile_photo(student_id, 'old.png')
+
+    response = client.post(f'/api/profile/{student_id}/photo',
+                           data={'photo': (io.BytesIO(b'new photo'), 'new.png')}, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert not os.path.exists(storage.blob_path(old))
+    assert model.Uploads.get_by_filename('old.png') is None
+    assert model.Students.get_by_id(student_id)['profile_photo'] == response.get_json()['photo']
+
+def test_rollback_keeps_the_blob(database):
+    digest = store('kept.pdf', b'kept')
+    with pytest.raises(RuntimeError):
+        with model.db_cursor():
+            storage.release('kept.pdf')
+            raise RuntimeError('abort')
+    assert os.path.exists(storage.blob_path(digest))
+    assert model.Uploads.count_references(digest) == 1
@@ -0,0 +1,8 @@
+"""Several worker processes on one local broker see each other's events (see check_workers.py)."""
+import check_workers
+
+def test_workers_share_events(database, tmp_path):
+    workers = 3
+    reports = check_workers.run(workers, 50, f'local://{tmp_path}/socketio.sock', database)
+    lines, failed = check_workers.summarize(reports, workers)
+    assert not failed, '\n'.join(lines)
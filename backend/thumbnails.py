@@ -0,0 +1,93 @@
+"""Resized avatar variants of uploaded profile photos, rendered off the request path."""
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+AVATAR_SIZES = (48, 128, 256)
+VARIANT_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+VARIANT_DIR = os.path.join(storage.UPLOAD_DIR, 'variants')
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+# 'thread' avoids forking, which gevent does not survive, so it is the default
+# there; the threads are gevent's native ones, and Pillow releases the GIL.
+THUMBNAIL_POOL = os.environ.get('THUMBNAIL_POOL') or ('thread' if _gevent_patched() else 'process')
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+def enabled():
+    return Image is not None
+
+def variant_path(sha256, size, fmt, variant_dir=VARIANT_DIR):
+    return os.path.join(variant_dir, sha256[:2], f'{sha256}_{size}.{fmt}')
+
+def render_variants(source, sha256, variant_dir=VARIANT_DIR):
+    """Write every size/format variant of `source`; runs inside a pool worker."""
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        os.makedirs(os.path.dirname(variant_path(sha256, 0, 'jpeg', variant_dir)), exist_ok=True)
+        for size in AVATAR_SIZES:
+            thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+            for fmt, pil_format in VARIANT_FORMATS.items():
+                target = variant_path(sha256, size, fmt, variant_dir)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+                with os.fdopen(fd, 'wb') as tmp:
+                    thumb.save(tmp, pil_format, quality=80, optimize=True)
+                os.replace(tmp_path, target)
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            if THUMBNAIL_POOL == 'process':
+                pool = ProcessPoolExecutor
+            elif _gevent_patched():
+                from gevent.threadpool import ThreadPoolExecutor as pool
+            else:
+                pool = ThreadPoolExecutor
+            _executor = pool(max_workers=THUMBNAIL_WORKERS)
+        return _executor
+
+def _finished(sha256, future):
+    with _lock:
+        _pending.discard(sha256)
+    if future.exception():
+        print(f'Thumbnail rendering failed for {sha256}: {future.exception()}')
+
+def schedule(source, sha256):
+    """Queue variant rendering for an image unless it is done or already queued."""
+    if not enabled() or lookup(sha256, AVATAR_SIZES[-1], 'jpeg'):
+        return None
+    with _lock:
+        if sha256 in _pending:
+            return None
+        _pending.add(sha256)
+    future = _get_executor().submit(render_variants, source, sha256, VARIANT_DIR)
+    future.add_done_callback(lambda f: _finished(sha256, f))
+    return future
+
+def lookup(sha256, size, fmt):
+    """Return the path of a rendered variant, or None if it does not exist yet."""
+    path = variant_path(sha256, size, fmt)
+    return path if os.path.exists(path) else None
+
+def shutdown():
+    with _lock:
+        executor = _executor
+    if executor is not None:
+        executor.shutdown(wait=True)
@@ -16,7 +16,8 @@ import Assignments from './Assignments'
 import Landing from './Landing'
 import './App.css'
 
-const socket = io('http://localhost:5000')
+// Websocket only: with several backend workers a polling session could land on the wrong one.
+const socket = io('http://localhost:5000', { transports: ['websocket'] })
 
 const App = () => {
   const [isDarkMode, setIsDarkMode] = useState(false)
@@ -40,6 +41,12 @@ const App = () => {
     return () => socket.off('notification')
   }, [user])
 
+  useEffect(() => {
+    if (!user?.socket_token) return
+    socket.auth = { token: user.socket_token }
+    socket.disconnect().connect()
+  }, [user?.socket_token])
+
   const toggleTheme = () => {
     const newTheme = isDarkMode ? 'light' : 'dark'
     setIsDarkMode(!isDarkMode)
@@ -108,7 +115,7 @@ const App = () => {
             {user && (
               <>
                 <img
-                  src={user.profile_photo ? `/uploads/${user.profile_photo}` : `https://ui-avatars.com/api/?name=${user.name}`}
+                  src={user.profile_photo ? `/uploads/${user.profile_photo}?size=48` : `https://ui-avatars.com/api/?name=${user.name}`}
                   alt="Profile"
                   className="profile-pic"
                   onClick={() => navigate('profile')}
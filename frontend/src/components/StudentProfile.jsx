@@ -79,7 +79,7 @@ const StudentProfile = ({ user, studentId, setPage }) => {
       ) : student ? (
         <div className="profile-content">
           <img
-            src={student.profile_photo ? `/uploads/${student.profile_photo}` : `https://ui-avatars.com/api/?name=${student.name}`}
+            src={student.profile_photo ? `/uploads/${student.profile_photo}?size=256` : `https://ui-avatars.com/api/?name=${student.name}`}
             alt={student.name}
             className="student-pic"
           />
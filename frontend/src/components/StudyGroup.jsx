@@ -79,7 +79,7 @@ const StudyGroup = ({ user, groupId, setPage }) => {
               return member ? (
                 <div key={member.id} className="member-item">
                   <img
-                    src={member.profile_photo ? `/uploads/${member.profile_photo}` : `https://ui-avatars.com/api/?name=${member.name}`}
+                    src={member.profile_photo ? `/uploads/${member.profile_photo}?size=48` : `https://ui-avatars.com/api/?name=${member.name}`}
                     alt={member.name}
                     className="member-pic"
                   />